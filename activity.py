@@ -19,6 +19,7 @@ from gettext import gettext as _
 
 from gi.repository import GObject
 GObject.threads_init()
+from gi.repository import GLib
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import WebKit
@@ -28,6 +29,13 @@ import dbus
 import os.path
 import json
 import socket
+import shutil
+import tempfile
+import time
+import uuid
+from collections import deque
+from collections import OrderedDict
+from threading import Lock
 
 from sugar3.activity import activity
 from sugar3.activity.widgets import ActivityToolbarButton
@@ -38,14 +46,30 @@ from sugar3.datastore import datastore
 from sugar3.graphics.xocolor import XoColor
 from sugar3 import profile
 from sugar3.graphics.objectchooser import ObjectChooser
+from sugar3.graphics.alert import Alert
 
 import downloadmanager
 from filepicker import FilePicker
+import packagecache
 import server
 import utils
 
 JOURNAL_STREAM_SERVICE = 'journal-activity-http'
 
+# metadata used to build the catalog, the preview is not requested
+# because is only needed when the object is packaged
+CATALOG_PROPERTIES = ['uid', 'title', 'description', 'comments',
+                      'shared_by', 'downloaded_by', 'timestamp', 'filesize']
+
+# number of catalog revisions kept to send only the changes to the
+# clients, the ones more behind receive all the catalog again
+CATALOG_CHANGES_KEPT = 100
+
+# the changes requested in this time (in ms) are merged in only one
+# catalog update, but the update is not delayed more than the max latency
+UPDATE_WINDOW = 500
+UPDATE_MAX_LATENCY = 2000
+
 # directory exists if powerd is running.  create a file here,
 # named after our pid, to inhibit suspend.
 POWERD_INHIBIT_DIR = '/var/run/powerd-inhibit-suspend'
@@ -95,13 +119,12 @@ class JournalShare(activity.Activity):
         add_button.connect('clicked', self.__add_clicked_cb)
         toolbar_box.toolbar.insert(add_button, -1)
 
-        if self._master:
-            add_favorites_button = ToolButton('emblem-favorite')
-            add_favorites_button.set_tooltip(_('Add favorite items to share'))
-            add_favorites_button.show()
-            add_favorites_button.connect('clicked',
-                                         self.__add_favorites_clicked_cb)
-            toolbar_box.toolbar.insert(add_favorites_button, -1)
+        add_favorites_button = ToolButton('emblem-favorite')
+        add_favorites_button.set_tooltip(_('Add favorite items to share'))
+        add_favorites_button.show()
+        add_favorites_button.connect('clicked',
+                                     self.__add_favorites_clicked_cb)
+        toolbar_box.toolbar.insert(add_favorites_button, -1)
 
         separator = Gtk.SeparatorToolItem()
         separator.props.draw = False
@@ -138,6 +161,11 @@ class JournalShare(activity.Activity):
 
         # collaboration
         self.unused_download_tubes = set()
+        self._uploader = None
+        # the directories with the links to the packages sent by
+        # every uploader, removed when the upload finishes
+        self._upload_dirs = {}
+        self._upload_alert = None
         self.connect("shared", self._shared_cb)
 
         if self.shared_activity:
@@ -169,47 +197,106 @@ class JournalShare(activity.Activity):
                 logging.debug('ObjectChooser: %r',
                               chooser.get_selected_object())
                 jobject = chooser.get_selected_object()
-                # add the information about the sharer
-                user_data = utils.get_user_data()
-                jobject.metadata['shared_by'] = json.dumps(user_data)
-                # And add a comment to the Journal entry
-                if 'comments' in jobject.metadata:
-                    comments = json.loads(jobject.metadata['comments'])
-                else:
-                    comments = []
-                comments.append(
-                    {'from': user_data['from'],
-                     'message': _('I shared this.'),
-                     'icon-color': '[%s,%s]' %
-                        (user_data['icon'][0], user_data['icon'][1])})
-                jobject.metadata['comments'] = json.dumps(comments)
+                _add_sharer_comment(jobject, utils.get_user_data())
 
                 if jobject and jobject.file_path:
                     if self._master:
                         datastore.write(jobject)
                         self._jm.append_to_shared_items(jobject.object_id)
                     else:
-                        tmp_path = os.path.join(self._activity_root,
-                                                'instance')
-                        logging.error('temp_path %s', tmp_path)
-                        packaged_file_path = utils.package_ds_object(
-                            jobject, tmp_path)
-                        url = 'ws://%s:%d/websocket/upload' % (self.ip,
-                                                               self.port)
-                        uploader = utils.Uploader(packaged_file_path, url)
-                        uploader.connect('uploaded', self.__uploaded_cb)
-                        cursor = Gdk.Cursor.new(Gdk.CursorType.WATCH)
-                        self.get_window().set_cursor(cursor)
-                        uploader.start()
+                        self._upload_packages(_link_packages(
+                            [jobject], self._get_upload_tmp_path()))
         finally:
             chooser.destroy()
             del chooser
 
+    def _get_upload_tmp_path(self):
+        return os.path.join(self._activity_root, 'tmp')
+
+    def _upload_packages(self, packages):
+        """
+        Send a list of (package path, fingerprint) to the server, all
+        are queued before the upload starts, and sent in the same
+        connection if the server supports it. The packages are links
+        out of the package cache, the cache can evict them meanwhile.
+        """
+        new_uploader = None
+        for file_path, fingerprint in packages:
+            # the objects shared while other upload is
+            # running are sent in the same connection
+            if self._uploader is None or \
+                    not self._uploader.add(file_path, fingerprint):
+                url = 'ws://%s:%d/websocket/upload' % (self.ip, self.port)
+                self._uploader = new_uploader = utils.Uploader(
+                    file_path, url, fingerprint)
+                self._uploader.connect('uploaded', self.__uploaded_cb)
+                self._uploader.connect('progress', self.__progress_cb)
+            self._upload_dirs.setdefault(self._uploader, []).append(
+                os.path.dirname(file_path))
+        if new_uploader is not None:
+            new_uploader.start()
+            self._show_upload_alert()
+        cursor = Gdk.Cursor.new(Gdk.CursorType.WATCH)
+        self.get_window().set_cursor(cursor)
+
+    def _show_upload_alert(self):
+        if self._upload_alert is None:
+            self._upload_alert = Alert()
+            self._upload_alert.props.title = _('Sharing')
+            self._upload_alert.props.msg = _('Connecting...')
+            self.add_alert(self._upload_alert)
+            self._upload_alert.show()
+
+    def __progress_cb(self, uploader, progress):
+        if uploader is not self._uploader or self._upload_alert is None:
+            return
+        if progress['eta'] is None:
+            eta = _('unknown')
+        else:
+            eta = _('%d s') % progress['eta']
+        self._upload_alert.props.msg = \
+            _('%(acked)s of %(total)s, %(rate)s/s, %(eta)s left') % \
+            {'acked': GLib.format_size(progress['acked']),
+             'total': GLib.format_size(progress['total']),
+             'rate': GLib.format_size(int(progress['rate'])),
+             'eta': eta}
+
     def __uploaded_cb(self, uploader):
-        self.get_window().set_cursor(None)
+        for tmp_dir in self._upload_dirs.pop(uploader, []):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if uploader is self._uploader:
+            self._uploader = None
+            self.get_window().set_cursor(None)
+            if self._upload_alert is not None:
+                self.remove_alert(self._upload_alert)
+                self._upload_alert = None
 
     def __add_favorites_clicked_cb(self, button):
-        self._jm.set_shared_items(['*'])
+        if self._master:
+            self._jm.set_shared_items(['*'])
+            return
+        # send all the favorites to the server in one upload, the
+        # datastore is read here and the objects packaged out of the
+        # main thread
+        dsobjects, _nobjects = datastore.find({'keep': '1'})
+        user_data = utils.get_user_data()
+        objects_data = []
+        for dsobj in dsobjects:
+            file_path = dsobj.get_file_path()
+            if file_path is None:
+                continue
+            _add_sharer_comment(dsobj, user_data)
+            objects_data.append(utils.ObjectData(
+                dsobj.object_id, dsobj.metadata, file_path))
+        if not objects_data:
+            return
+        utils.get_worker_pool().submit(
+            _link_packages, (objects_data, self._get_upload_tmp_path()),
+            self.__favorites_packaged_cb)
+
+    def __favorites_packaged_cb(self, job, packages):
+        if packages:
+            self._upload_packages(packages)
 
     def _get_view_information(self):
         # Pick an arbitrary tube we can try to connect to the server
@@ -349,7 +436,8 @@ class JournalShare(activity.Activity):
 
     def can_close(self):
         self._allow_suspend()
-        # remove temporary files
+        # remove temporary files, the package cache is in the data
+        # directory and is kept for the next session
         instance_path = self._activity_root + '/instance/'
         for file_name in os.listdir(instance_path):
             file_path = os.path.join(instance_path, file_name)
@@ -384,10 +472,51 @@ class JournalManager(GObject.GObject):
 
     __gsignals__ = {'updated': (GObject.SignalFlags.RUN_FIRST, None, ([]))}
 
-    def __init__(self, activity_root):
+    def __init__(self, activity_root, update_window=UPDATE_WINDOW,
+                 update_max_latency=UPDATE_MAX_LATENCY):
         GObject.GObject.__init__(self)
         self._instance_path = activity_root + '/instance/'
         self._shared_items = []
+        # incremental catalog, object_id -> dictionary with the row,
+        # the package state and the published json of the row.
+        # only the objects whose state changed are packaged again
+        self._catalog = {}
+        self._catalog_order = []
+        # the packages are built in background when requested, the
+        # items are published without waiting for them
+        self._workers = utils.WorkerPool()
+        # object_id -> kinds ('preview' or 'package') already built
+        self._packaged = {}
+        # (object_id, kind) -> packaging job in progress
+        self._package_jobs = {}
+        # (object_id, kind) -> callbacks waiting for the files
+        self._package_waiters = {}
+        # every change in the published catalog increments the revision,
+        # the changes are kept as lists of operations to send only them
+        # to the web clients. Are read from the web server thread.
+        self._catalog_lock = Lock()
+        self._revision = 0
+        # the revisions are comparable only with the same epoch, the
+        # clients of a previous instance receive all the catalog again
+        self.catalog_epoch = uuid.uuid4().hex
+        self._snapshot = '[]'
+        self._changes = deque(maxlen=CATALOG_CHANGES_KEPT)
+        self._pending_changes = []
+        # when all the favorites are shared, they are indexed in memory,
+        # object_id -> dsobj with the catalog properties, and updated with
+        # the datastore signals. Only the changed objects are checked.
+        self._favorites = None
+        self._changed_favorites = set()
+        self._datastore_signals = []
+        self._connect_to_datastore()
+        # coalescing of the updates
+        self._update_window = update_window
+        self._update_max_latency = update_max_latency
+        self._update_timeout = None
+        self._first_update_request = None
+        self._rebuild_pending = False
+        self.update_requests = 0
+        self.updates_done = 0
         try:
             self.nick_name = profile.get_nick_name()
         except:
@@ -405,20 +534,111 @@ class JournalManager(GObject.GObject):
         owner_info_file.write(self.get_journal_owner_info())
         owner_info_file.close()
 
-        self._update_temporary_files()
+        self._rebuild_pending = True
+        self._flush_updates()
 
     def set_shared_items(self, shared_items):
         self._shared_items = shared_items
+        # the favorites index is created again if needed
+        self._favorites = None
         self._update_temporary_files()
 
     def _update_temporary_files(self):
+        self._schedule_update(rebuild=True)
+
+    def _schedule_update(self, rebuild):
+        """
+        Request a catalog update, rebuild is True when the shared items
+        need be read again from the datastore, or False to only publish
+        the pending changes. The requests are merged, the update is done
+        after update_window ms without new requests, or after
+        update_max_latency ms from the first request.
+        """
+        self.update_requests += 1
+        self._rebuild_pending = self._rebuild_pending or rebuild
+        now = time.time()
+        if self._first_update_request is None:
+            self._first_update_request = now
+        if self._update_timeout is not None:
+            GObject.source_remove(self._update_timeout)
+
+        elapsed = (now - self._first_update_request) * 1000
+        delay = max(0, min(self._update_window,
+                           self._update_max_latency - elapsed))
+        self._update_timeout = GObject.timeout_add(int(delay),
+                                                   self._flush_updates)
+
+    def _flush_updates(self):
+        self._update_timeout = None
+        self._first_update_request = None
+        self.updates_done += 1
+        if self._rebuild_pending:
+            self._rebuild_pending = False
+            self._prepare_shared_items()
+        self._write_catalog()
+        logging.debug('Catalog updates: %s', self.get_update_stats())
+        return False
+
+    def get_update_stats(self):
+        """
+        Return the number of updates requested, the number done, and the
+        coalescing ratio between them
+        """
+        return {'requests': self.update_requests,
+                'updates': self.updates_done,
+                'ratio': float(self.update_requests) /
+                max(1, self.updates_done)}
+
+    def _write_catalog(self):
+        rows_json = []
+        for object_id in self._catalog_order:
+            row_json = self._catalog[object_id]['json']
+            if row_json is not None:
+                rows_json.append(row_json)
+        snapshot = '[%s]' % ', '.join(rows_json)
+
+        with self._catalog_lock:
+            if self._pending_changes:
+                self._revision += 1
+                self._changes.append((self._revision, self._pending_changes))
+                self._pending_changes = []
+            self._snapshot = snapshot
+
         selected_file_path = os.path.join(self._instance_path,
                                           'selected.json')
         selected_file = open(selected_file_path, 'w')
-        selected_file.write(self._prepare_shared_items())
+        selected_file.write(snapshot)
         selected_file.close()
         self.emit('updated')
 
+    def get_catalog_snapshot(self):
+        """
+        Return a tuple with the revision of the published catalog and
+        the json of the list of items. Can be called from any thread.
+        """
+        with self._catalog_lock:
+            return self._revision, self._snapshot
+
+    def get_catalog_changes(self, revision):
+        """
+        Return a tuple with the current revision and the list of
+        operations to apply to the catalog at revision to update it,
+        or None if the changes are not available anymore.
+        The operations are {'op': 'add' or 'update', 'item': row} and
+        {'op': 'remove', 'id': object_id}. Can be called from any thread.
+        """
+        with self._catalog_lock:
+            if revision == self._revision:
+                return self._revision, []
+            if revision > self._revision or not self._changes or \
+                    self._changes[0][0] > revision + 1:
+                return None
+            operations = []
+            for change_revision, change_operations in self._changes:
+                if change_revision > revision:
+                    operations.extend(change_operations)
+            return self._revision, operations
+
     def get_shared_items(self):
         return self._shared_items
 
@@ -453,67 +673,352 @@ class JournalManager(GObject.GObject):
         self._update_temporary_files()
 
     def create_object(self, file_path, metadata, preview_content):
-        new_dsobject = datastore.create()
-        #Set the file_path in the datastore.
-        new_dsobject.set_file_path(file_path)
-
-        for key in metadata.keys():
-            new_dsobject.metadata[key] = metadata[key]
-
-        if preview_content is not None and preview_content != '':
-            new_dsobject.metadata['preview'] = \
-                dbus.ByteArray(preview_content)
-        datastore.write(new_dsobject)
-        if self._shared_items == ['*']:
-            # mark as favorite
-            new_dsobject.metadata['keep'] = '1'
-            self._update_temporary_files()
-        else:
-            self.append_to_shared_items(new_dsobject.object_id)
+        return self.create_objects([(file_path, metadata, preview_content)])
+
+    def create_objects(self, objects):
+        """
+        Save in the datastore the objects received from other users,
+        a list of (file_path, metadata, preview_content), and update
+        the catalog only one time
+        """
+        for file_path, metadata, preview_content in objects:
+            new_dsobject = datastore.create()
+            #Set the file_path in the datastore.
+            new_dsobject.set_file_path(file_path)
+
+            for key in metadata.keys():
+                new_dsobject.metadata[key] = metadata[key]
+
+            if preview_content is not None and preview_content != '':
+                new_dsobject.metadata['preview'] = \
+                    dbus.ByteArray(preview_content)
+            if self._shared_items == ['*']:
+                # mark as favorite
+                new_dsobject.metadata['keep'] = '1'
+            datastore.write(new_dsobject)
+            if self._shared_items == ['*']:
+                self._changed_favorites.add(new_dsobject.object_id)
+            else:
+                self._shared_items.append(new_dsobject.object_id)
+        self._update_temporary_files()
         return False
 
     def _prepare_shared_items(self):
-        results = []
         if not self._shared_items:
-            return json.dumps(results)
-
-        if self._shared_items == ['*']:
-            dsobjects, _nobjects = datastore.find({'keep': '1'})
-        else:
             dsobjects = []
-            for object_id in self._shared_items:
-                dsobjects.append(datastore.get(object_id))
-
+        elif self._shared_items == ['*']:
+            dsobjects = self._get_favorites()
+        else:
+            # get all the objects in only one call
+            dsobjects, _nobjects = datastore.find(
+                {'uid': self._shared_items}, properties=CATALOG_PROPERTIES)
+            positions = {}
+            for position, object_id in enumerate(self._shared_items):
+                positions.setdefault(object_id, position)
+            dsobjects.sort(key=lambda dsobj: positions[dsobj.object_id])
+
+        # with the favorites index, only the changed objects are checked
+        indexed = self._shared_items == ['*'] and self._favorites is not None
+        catalog = {}
         for dsobj in dsobjects:
-            title = ''
-            desc = ''
-            comment = []
-            shared_by = {}
-            downloaded_by = []
             object_id = dsobj.object_id
-            if hasattr(dsobj, 'metadata'):
-                if 'title' in dsobj.metadata:
-                    title = dsobj.metadata['title']
-                if 'description' in dsobj.metadata:
-                    desc = dsobj.metadata['description']
-                if 'comments' in dsobj.metadata:
-                    try:
-                        comment = json.loads(dsobj.metadata['comments'])
-                    except:
-                        comment = []
-                if 'shared_by' in dsobj.metadata:
-                    shared_by = json.loads(dsobj.metadata['shared_by'])
-                if 'downloaded_by' in dsobj.metadata:
-                    downloaded_by = json.loads(
-                        dsobj.metadata['downloaded_by'])
+            if indexed and object_id in self._catalog and \
+                    object_id not in self._changed_favorites:
+                catalog[object_id] = self._catalog[object_id]
+                continue
+            row = self._prepare_catalog_row(dsobj)
+            state = self._get_package_state(dsobj)
+            entry = self._catalog.get(object_id)
+            if entry is None:
+                entry = {'row': None, 'state': None, 'json': None}
+
+            if row != entry['row'] or state != entry['state']:
+                # the package includes the metadata, then need be rebuilt
+                # if the row changed too, when is requested again
+                logging.debug('Object %s changed', object_id)
+                entry['row'] = row
+                entry['state'] = state
+                self._invalidate_package(object_id)
+                row_json = json.dumps(row)
+                if row_json != entry['json']:
+                    operation = 'add' if entry['json'] is None else 'update'
+                    self._pending_changes.append({'op': operation,
+                                                  'item': row})
+                    entry['json'] = row_json
+
+            catalog[object_id] = entry
+
+        # cancel the builds of the objects not shared anymore
+        for object_id in self._catalog:
+            if object_id not in catalog:
+                self._remove_package(object_id)
+                if self._catalog[object_id]['json'] is not None:
+                    self._pending_changes.append({'op': 'remove',
+                                                  'id': object_id})
+        self._catalog = catalog
+        self._catalog_order = [dsobj.object_id for dsobj in dsobjects]
+        self._changed_favorites.clear()
+
+    def _get_favorites(self):
+        if self._favorites is not None:
+            return self._favorites.values()
+
+        dsobjects, _nobjects = datastore.find(
+            {'keep': '1'}, properties=CATALOG_PROPERTIES)
+        if self._datastore_signals:
+            # without signals the favorites are searched every time
+            self._favorites = OrderedDict(
+                [(dsobj.object_id, dsobj) for dsobj in dsobjects])
+            self._changed_favorites.update(self._favorites.keys())
+        return dsobjects
+
+    def _connect_to_datastore(self):
+        try:
+            bus = dbus.SessionBus()
+            obj = bus.get_object(downloadmanager.DS_DBUS_SERVICE,
+                                 downloadmanager.DS_DBUS_PATH)
+            datastore_dbus = dbus.Interface(
+                obj, downloadmanager.DS_DBUS_INTERFACE)
+            for signal_name, callback in (
+                    ('Created', self.__datastore_updated_cb),
+                    ('Updated', self.__datastore_updated_cb),
+                    ('Deleted', self.__datastore_deleted_cb)):
+                self._datastore_signals.append(
+                    datastore_dbus.connect_to_signal(signal_name, callback))
+        except:
+            logging.exception('Can\'t connect to the datastore signals')
+            for handler in self._datastore_signals:
+                handler.remove()
+            self._datastore_signals = []
+
+    def __datastore_updated_cb(self, object_id):
+        if self._favorites is None:
+            return
+        object_id = str(object_id)
+        dsobjects, _nobjects = datastore.find(
+            {'uid': object_id}, properties=CATALOG_PROPERTIES + ['keep'])
+        if dsobjects and dsobjects[0].metadata.get('keep') == '1':
+            self._favorites[object_id] = dsobjects[0]
+        elif object_id in self._favorites:
+            del self._favorites[object_id]
+        else:
+            return
+        self._changed_favorites.add(object_id)
+        self._update_temporary_files()
+
+    def __datastore_deleted_cb(self, object_id):
+        if self._favorites is None:
+            return
+        object_id = str(object_id)
+        if object_id in self._favorites:
+            del self._favorites[object_id]
+            self._update_temporary_files()
+
+    def _prepare_catalog_row(self, dsobj):
+        title = ''
+        desc = ''
+        comment = []
+        shared_by = {}
+        downloaded_by = []
+        object_id = dsobj.object_id
+        if hasattr(dsobj, 'metadata'):
+            if 'title' in dsobj.metadata:
+                title = dsobj.metadata['title']
+            if 'description' in dsobj.metadata:
+                desc = dsobj.metadata['description']
+            if 'comments' in dsobj.metadata:
+                try:
+                    comment = json.loads(dsobj.metadata['comments'])
+                except:
+                    comment = []
+            if 'shared_by' in dsobj.metadata:
+                shared_by = json.loads(dsobj.metadata['shared_by'])
+            if 'downloaded_by' in dsobj.metadata:
+                downloaded_by = json.loads(
+                    dsobj.metadata['downloaded_by'])
+        else:
+            logging.debug('dsobj has no metadata')
+
+        return {'title': str(title), 'desc': str(desc),
+                'comment': comment, 'id': str(object_id),
+                'shared_by': shared_by,
+                'downloaded_by': downloaded_by}
+
+    def _get_package_state(self, dsobj):
+        """
+        Return the values a package depends on: the timestamp and the
+        size of the data file, from the metadata, to not ask the
+        datastore the file of every object
+        """
+        if not hasattr(dsobj, 'metadata'):
+            return (None, None)
+        return (dsobj.metadata.get('timestamp'),
+                dsobj.metadata.get('filesize'))
+
+    def _invalidate_package(self, object_id):
+        self._packaged.pop(object_id, None)
+        for kind in ('preview', 'package'):
+            key = (object_id, kind)
+            job = self._package_jobs.pop(key, None)
+            if job is not None:
+                job.cancel()
+                if key in self._package_waiters:
+                    # requested before the change, build the new version
+                    self._queue_package(object_id, kind,
+                                        priority=utils.PRIORITY_HIGH)
+
+    def _queue_package(self, object_id, kind, priority=utils.PRIORITY_LOW):
+        # the catalog only have some properties, get all the metadata
+        # and the file path here, the workers don't use D-Bus
+        try:
+            dsobj = datastore.get(object_id)
+            file_path = None
+            if kind == 'package':
+                file_path = dsobj.get_file_path()
+            object_data = utils.ObjectData(object_id, dsobj.metadata,
+                                           file_path)
+        except:
+            logging.exception('Can\'t read object %s', object_id)
+            for callback in self._package_waiters.pop((object_id, kind), []):
+                callback(None)
+            return
+        self._package_jobs[(object_id, kind)] = self._workers.submit(
+            _package_in_temporary_dir,
+            (object_data, kind, self._instance_path),
+            self.__package_done_cb, object_id, kind, priority=priority)
+
+    def __package_done_cb(self, job, tmp_dir, object_id, kind):
+        key = (object_id, kind)
+        if self._package_jobs.get(key) is not job:
+            # cancelled or replaced by a newer build
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        del self._package_jobs[key]
+        file_path = None
+        if tmp_dir is not None:
+            # replace the old files only when the new ones are ready
+            for file_name in os.listdir(tmp_dir):
+                os.rename(os.path.join(tmp_dir, file_name),
+                          os.path.join(self._instance_path, file_name))
+            os.rmdir(tmp_dir)
+            # the package includes the preview. The objects without
+            # preview are marked as built too, the web server will
+            # answer not found
+            if kind == 'preview':
+                built = ['preview']
             else:
-                logging.debug('dsobj has no metadata')
+                built = ['preview', 'package']
+            self._packaged.setdefault(object_id, set()).update(built)
+            file_path = self._get_packaged_file_path(object_id, kind)
+        else:
+            logging.error('Can\'t package object %s', object_id)
+
+        for callback in self._package_waiters.pop(key, []):
+            callback(file_path)
+
+    def _remove_package(self, object_id):
+        for kind in ('preview', 'package'):
+            key = (object_id, kind)
+            job = self._package_jobs.pop(key, None)
+            if job is not None:
+                job.cancel()
+            for callback in self._package_waiters.pop(key, []):
+                callback(None)
+        self._packaged.pop(object_id, None)
+        utils.remove_packaged_files(object_id, self._instance_path)
+
+    def request_package(self, object_id, kind, callback):
+        """
+        Get the files of a shared object, kind is 'preview' to only save
+        the preview, or 'package' to create the .journal file. When the
+        files are ready callback(file_path) is called, with None if the
+        object is not shared or the build failed. The files are built
+        the first time are requested, and concurrent requests wait for
+        the same build.
+        Need be called from the main thread, like the callback.
+        """
+        if object_id not in self._catalog:
+            callback(None)
+            return False
 
-            utils.package_ds_object(dsobj, self._instance_path)
+        if kind in self._packaged.get(object_id, ()):
+            callback(self._get_packaged_file_path(object_id, kind))
+            return False
+
+        key = (object_id, kind)
+        self._package_waiters.setdefault(key, []).append(callback)
+        if key not in self._package_jobs:
+            self._queue_package(object_id, kind, priority=utils.PRIORITY_HIGH)
+        return False
 
-            results.append({'title': str(title), 'desc': str(desc),
-                            'comment': comment, 'id': str(object_id),
-                            'shared_by': shared_by,
-                            'downloaded_by': downloaded_by})
-        logging.error(results)
-        return json.dumps(results)
+    def _get_packaged_file_path(self, object_id, kind):
+        if kind == 'preview':
+            file_name = 'preview_id_' + object_id
+        else:
+            file_name = 'id_' + object_id + '.journal'
+        return os.path.join(self._instance_path, file_name)
+
+
+def _add_sharer_comment(dsobj, user_data):
+    """
+    Add to the metadata of a journal object the information about the
+    sharer, and a comment saying it was shared
+    """
+    dsobj.metadata['shared_by'] = json.dumps(user_data)
+    if 'comments' in dsobj.metadata:
+        comments = json.loads(dsobj.metadata['comments'])
+    else:
+        comments = []
+    comments.append(
+        {'from': user_data['from'],
+         'message': _('I shared this.'),
+         'icon-color': '[%s,%s]' %
+            (user_data['icon'][0], user_data['icon'][1])})
+    dsobj.metadata['comments'] = json.dumps(comments)
+
+
+def _link_packages(objects_data, tmp_path):
+    """
+    Package journal objects to upload them, and link every package in a
+    new directory in tmp_path, like FilePicker does, to keep it while
+    the upload runs. objects_data are journal objects or
+    utils.ObjectData, and return a list of (package path, fingerprint).
+    Can run in a worker thread with utils.ObjectData.
+    """
+    cache = packagecache.get_package_cache()
+    packages = []
+    for object_data in objects_data:
+        tmp_dir = tempfile.mkdtemp(prefix='', dir=tmp_path)
+        try:
+            packages.append((cache.link_package(object_data, tmp_dir),
+                             packagecache.get_fingerprint(object_data)))
+        except:
+            logging.exception('Can\'t package object %s',
+                              object_data.object_id)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return packages
+
+
+def _package_in_temporary_dir(object_data, kind, instance_path):
+    """
+    Save the preview of a journal object, or package it if kind is
+    'package', in a new directory, run in a worker thread.
+    object_data is a utils.ObjectData read in the main thread.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=instance_path)
+    try:
+        if kind == 'preview':
+            # the list only needs the previews, the data is not read
+            utils.save_preview(object_data, tmp_dir)
+        else:
+            if object_data.file_path is None:
+                raise ValueError('Object %s has no file' %
+                                 object_data.object_id)
+            packagecache.get_package_cache().link_package(object_data,
+                                                          tmp_dir)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return tmp_dir
@@ -40,8 +40,6 @@ DS_DBUS_PATH = '/org/laptop/sugar/DataStore'
 _active_downloads = []
 _dest_to_window = {}
 
-SPACE_THRESHOLD = 52428800
-
 
 def format_float(f):
     return "%0.2f" % f
@@ -120,7 +118,7 @@ class Download(object):
 
                 total_size_mb = total_size / 1024.0 ** 2
                 free_space_mb = self._free_available_space(
-                    path=self.temp_path) - SPACE_THRESHOLD / 1024.0 ** 2
+                    path=self.temp_path) - utils.SPACE_THRESHOLD / 1024.0 ** 2
                 filename = self._download.get_suggested_filename()
                 self._canceled_alert.props.msg = \
                     _('Download "%{filename}" requires %{total_size_in_mb}'
@@ -284,11 +282,10 @@ class Download(object):
         """
 
         free_space = self._free_available_space(path=path)
-        return free_space - size > SPACE_THRESHOLD
+        return free_space - size > utils.SPACE_THRESHOLD
 
     def _free_available_space(self, path='/'):
-        s = os.statvfs(path)
-        return s.f_bavail * s.f_frsize
+        return utils.get_free_space(path)
 
     def _create_journal_object(self):
         self.dl_jobject = datastore.create()
@@ -18,7 +18,7 @@ import logging
 import os
 import tempfile
 import shutil
-import utils
+import packagecache
 
 from gi.repository import Gtk
 
@@ -57,7 +57,8 @@ class FilePicker(ObjectChooser):
                         prefix='',
                         dir=os.path.join(get_activity_root(), 'tmp'))
 
-                    _file = utils.package_ds_object(jobject, tmp_dir)
+                    _file = packagecache.get_package_cache().link_package(
+                        jobject, tmp_dir)
 
                     global _temp_dirs_to_clean
                     _temp_dirs_to_clean.append(tmp_dir)
@@ -0,0 +1,207 @@
+# Copyright 2013 Agustin Zubiaga <aguz@sugarlabs.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import base64
+import shutil
+import logging
+import tempfile
+import Queue
+from threading import Thread
+
+import utils
+
+# chunks received waiting to be written, of all the uploads
+DECODE_QUEUE_SIZE = 64
+# packages received waiting to be unzipped
+UNZIP_QUEUE_SIZE = 4
+
+# markers sent after the data of an Ingest
+FINISH = object()
+ABORT = object()
+
+_pipeline = None
+
+
+def get_ingest_pipeline():
+    """
+    Return the pipeline shared by all the uploads
+    """
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = IngestPipeline()
+    return _pipeline
+
+
+class Ingest(object):
+    """
+    A package being received.
+
+    The data is written in package_path (opened with mode), decoded
+    from base64 if encoded is True. When finished the package is
+    unzipped in a new directory in instance_path, and done_callback is
+    called with a (file_path, metadata, preview) tuple, or None if the
+    package can't be unzipped or written. If metadata is not None, it
+    replaces the metadata and preview in the package. The files in
+    remove_paths are removed after unzipping. The callbacks are called
+    in the threads of the pipeline.
+
+    If the package can't be written, failed is True, the package is
+    removed and the data received after is discarded.
+    """
+
+    def __init__(self, instance_path, package_path, mode, encoded,
+                 ack_callback, done_callback, received=0,
+                 remove_paths=()):
+        self.instance_path = instance_path
+        self.package_path = package_path
+        self.encoded = encoded
+        self.ack_callback = ack_callback
+        self.done_callback = done_callback
+        self.remove_paths = remove_paths
+        self.metadata = None
+        self.preview_data = None
+        # bytes received, including the ones written in a previous
+        # connection, used by the tornado thread
+        self.received = received
+        # bytes received and written to disk, used by the pipeline
+        self.written = received
+        # True when the package file is closed
+        self.closed = False
+        # True when the package can't be written
+        self.failed = False
+        # True when the FINISH marker was sent, used by the tornado thread
+        self.finished = False
+        self._mode = mode
+        self._file = None
+        self._carry = ''
+
+    def write(self, data):
+        if self._file is None:
+            self._file = open(self.package_path, self._mode)
+        self.written += len(data)
+        if self.encoded:
+            # decode only groups of 4 characters,
+            # the rest is decoded with the next chunk
+            data = self._carry + ''.join(str(data).split())
+            length = len(data) - len(data) % 4
+            self._carry = data[length:]
+            data = base64.b64decode(data[:length])
+        self._file.write(data)
+
+    def close(self):
+        if self._file is not None:
+            if self._carry:
+                logging.error('Incomplete base64 data in %s',
+                              self.package_path)
+            self._file.close()
+        self.closed = True
+
+    def fail(self):
+        """
+        Discard the package after an error writing it
+        """
+        self.failed = True
+        self.closed = True
+        try:
+            if self._file is not None:
+                self._file.close()
+            for path in (self.package_path,) + tuple(self.remove_paths):
+                if os.path.exists(path):
+                    os.remove(path)
+        except (IOError, OSError), e:
+            logging.error('Error removing %s: %s', self.package_path, e)
+
+    def unzip(self):
+        tmp_dir = tempfile.mkdtemp(dir=self.instance_path)
+        try:
+            metadata, preview_data, file_path = \
+                utils.unpackage_ds_object(self.package_path, tmp_dir)
+        except Exception, e:
+            # the upload is incomplete
+            logging.error('Can\'t unpackage the upload: %s', e)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+        finally:
+            for path in (self.package_path,) + tuple(self.remove_paths):
+                if os.path.exists(path):
+                    os.remove(path)
+        logging.error('METADATA %s', metadata)
+
+        if self.metadata is not None:
+            metadata = self.metadata
+            preview_data = self.preview_data
+        return file_path, metadata, preview_data
+
+
+class IngestPipeline(object):
+    """
+    Save the uploads in stages, every one in his thread: the data is
+    decoded and written as it arrives, and the packages received are
+    unzipped. The queues between the stages are bounded, when the
+    unzip stage is behind, the decode stage waits, and the data
+    written is acknowledged later, stopping the clients.
+    """
+
+    def __init__(self):
+        self._decode_queue = Queue.Queue(DECODE_QUEUE_SIZE)
+        self._unzip_queue = Queue.Queue(UNZIP_QUEUE_SIZE)
+        for target in (self._decode, self._unzip):
+            thread = Thread(target=target)
+            thread.setDaemon(True)
+            thread.start()
+
+    def put(self, ingest, item):
+        """
+        Add data received for an ingest, or the FINISH or ABORT markers,
+        without blocking. Return False if the queue is full.
+        """
+        try:
+            self._decode_queue.put_nowait((ingest, item))
+        except Queue.Full:
+            return False
+        return True
+
+    def _decode(self):
+        while True:
+            ingest, item = self._decode_queue.get()
+            if ingest.failed:
+                # done_callback was called already
+                continue
+            try:
+                if item is FINISH:
+                    ingest.close()
+                    self._unzip_queue.put(ingest)
+                elif item is ABORT:
+                    ingest.close()
+                else:
+                    ingest.write(item)
+                    ingest.ack_callback(ingest.written)
+            except Exception, e:
+                logging.error('Error saving %s: %s', ingest.package_path, e)
+                ingest.fail()
+                ingest.done_callback(None)
+
+    def _unzip(self):
+        while True:
+            ingest = self._unzip_queue.get()
+            try:
+                result = ingest.unzip()
+            except Exception, e:
+                logging.error('Error unzipping %s: %s',
+                              ingest.package_path, e)
+                result = None
+            ingest.done_callback(result)
@@ -0,0 +1,229 @@
+# Copyright 2013 Agustin Zubiaga <aguz@sugarlabs.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from threading import Lock
+
+from sugar3.activity.activity import get_activity_root
+
+import utils
+
+# maximum size of the packages in the cache, in bytes
+CACHE_MAX_SIZE = 104857600
+
+# the use of the cached packages only changes the last_used time in the
+# index, it is saved with the next package or after this many seconds
+INDEX_SAVE_INTERVAL = 60
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_package_cache():
+    """
+    Return the package cache shared by all the users in the activity,
+    it is saved in the data directory to survive restarts
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PackageCache(os.path.join(get_activity_root(), 'data',
+                                               'package_cache'))
+    return _cache
+
+
+def get_fingerprint(dsobj):
+    """
+    Return a key identifying the content of a package: the object_id,
+    the metadata, and the size and modification time of the data file
+    (the datastore don't modify the files, then a new version of the
+    object has a different file)
+    """
+    metadata = {}
+    for key in dsobj.metadata.keys():
+        if key not in ('preview', 'progress'):
+            metadata[key] = dsobj.metadata[key]
+
+    hasher = hashlib.sha1()
+    hasher.update(dsobj.object_id)
+    hasher.update(json.dumps(metadata, sort_keys=True, default=str))
+    if 'preview' in dsobj.metadata:
+        hasher.update(hashlib.sha1(dsobj.metadata['preview']).hexdigest())
+    stat = os.stat(dsobj.file_path)
+    hasher.update('%d %f' % (stat.st_size, stat.st_mtime))
+    return hasher.hexdigest()
+
+
+class PackageCache(object):
+    """
+    Keep the packages created by utils.package_ds_object, one directory
+    for every fingerprint. The callers get hard links to the cached
+    files, and the least recently used packages are removed when the
+    cache is bigger than max_size. Can be used from any thread.
+    """
+
+    def __init__(self, cache_path, max_size=CACHE_MAX_SIZE):
+        self._cache_path = cache_path
+        self._index_path = os.path.join(cache_path, 'index.json')
+        self._max_size = max_size
+        self._lock = Lock()
+        # fingerprint -> {'object_id', 'size', 'content_hash', 'last_used'}
+        self._index = {}
+        # content_hash -> fingerprint, to find the content without
+        # scanning the index
+        self._by_content = {}
+        self._save_time = time.time()
+
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+        try:
+            with open(self._index_path) as index_file:
+                self._index = json.load(index_file)
+        except (IOError, ValueError):
+            self._index = {}
+
+        # forget the packages removed from disk, and the other way around
+        for fingerprint in self._index.keys():
+            if not os.path.isdir(os.path.join(cache_path, fingerprint)):
+                del self._index[fingerprint]
+        for file_name in os.listdir(cache_path):
+            file_path = os.path.join(cache_path, file_name)
+            if os.path.isdir(file_path) and file_name not in self._index:
+                shutil.rmtree(file_path, ignore_errors=True)
+        for fingerprint, entry in self._index.items():
+            if entry.get('content_hash') is not None:
+                self._by_content[entry['content_hash']] = fingerprint
+
+    def get_package(self, dsobj):
+        """
+        Return the path of the cached .journal file of a journal object,
+        packaging it if is not in the cache
+        """
+        fingerprint = get_fingerprint(dsobj)
+        package_path = os.path.join(self._cache_path, fingerprint)
+        with self._lock:
+            if fingerprint in self._index:
+                self._touch(fingerprint)
+                return self._get_journal_path(package_path, dsobj.object_id)
+
+        tmp_dir = tempfile.mkdtemp(dir=self._cache_path, prefix='.')
+        try:
+            tmp_journal_path = utils.package_ds_object(dsobj, tmp_dir)
+            # hash the data in the package just written, probably still
+            # in memory, instead of reading the datastore file again
+            content_hash = utils.get_package_content_hash(tmp_journal_path)
+        except:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        size = 0
+        for file_name in os.listdir(tmp_dir):
+            size += os.path.getsize(os.path.join(tmp_dir, file_name))
+
+        with self._lock:
+            if fingerprint in self._index:
+                # packaged by other thread at the same time
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            else:
+                os.rename(tmp_dir, package_path)
+            self._index[fingerprint] = {'object_id': dsobj.object_id,
+                                        'size': size,
+                                        'content_hash': content_hash,
+                                        'last_used': time.time()}
+            self._by_content[content_hash] = fingerprint
+            self._evict(fingerprint)
+            self._save_index()
+        return self._get_journal_path(package_path, dsobj.object_id)
+
+    def link_package(self, dsobj, destination_path):
+        """
+        Hard link the files of the package of a journal object (the
+        .journal file, the metadata and the preview) in destination_path,
+        and return the path of the .journal file there
+        """
+        while True:
+            journal_path = self.get_package(dsobj)
+            package_path = os.path.dirname(journal_path)
+            with self._lock:
+                # other thread can evict the package after get_package
+                # released the lock, then it is packaged again
+                if os.path.basename(package_path) not in self._index:
+                    continue
+                for file_name in os.listdir(package_path):
+                    source = os.path.join(package_path, file_name)
+                    target = os.path.join(destination_path, file_name)
+                    if os.path.exists(target):
+                        os.remove(target)
+                    try:
+                        os.link(source, target)
+                    except OSError:
+                        # other file system
+                        shutil.copy(source, target)
+            return os.path.join(destination_path,
+                                os.path.basename(journal_path))
+
+    def find_content(self, content_hash):
+        """
+        Return the path of a cached .journal file with data matching
+        content_hash (see utils.get_content_hash), or None
+        """
+        with self._lock:
+            fingerprint = self._by_content.get(content_hash)
+            if fingerprint is None:
+                return None
+            self._touch(fingerprint)
+            return self._get_journal_path(
+                os.path.join(self._cache_path, fingerprint),
+                self._index[fingerprint]['object_id'])
+
+    def _get_journal_path(self, package_path, object_id):
+        return os.path.join(package_path, 'id_' + object_id + '.journal')
+
+    def _evict(self, keep):
+        total_size = sum(entry['size'] for entry in self._index.values())
+        by_age = sorted(self._index.keys(),
+                        key=lambda key: self._index[key]['last_used'])
+        for fingerprint in by_age:
+            if total_size <= self._max_size:
+                break
+            if fingerprint == keep:
+                continue
+            logging.debug('Removing package %s from the cache', fingerprint)
+            entry = self._index.pop(fingerprint)
+            total_size -= entry['size']
+            if self._by_content.get(entry.get('content_hash')) == fingerprint:
+                del self._by_content[entry['content_hash']]
+            shutil.rmtree(os.path.join(self._cache_path, fingerprint),
+                          ignore_errors=True)
+
+    def _touch(self, fingerprint):
+        now = time.time()
+        self._index[fingerprint]['last_used'] = now
+        if now - self._save_time >= INDEX_SAVE_INTERVAL:
+            self._save_index()
+
+    def _save_index(self):
+        self._save_time = time.time()
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump(self._index, index_file)
+        os.rename(tmp_path, self._index_path)
@@ -15,7 +15,10 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import re
+import time
 import logging
+from collections import deque
 
 from tornado import httpserver
 from tornado import ioloop
@@ -25,6 +28,8 @@ from tornado import websocket
 from gi.repository import GLib
 
 import utils
+import ingest
+import packagecache
 import tempfile
 import base64
 import json
@@ -33,9 +38,77 @@ import StringIO
 import cairo
 from sugar3.graphics.icon import _IconBuffer
 
+# files created by utils.package_ds_object
+PACKAGED_FILE_RE = re.compile(r'^(preview_id_|metadata_id_|id_)'
+                              r'([\w-]+?)(\.journal)?$')
+
+UPLOAD_ID_RE = re.compile(r'^[\w-]+$')
+# files of the partial uploads, see get_partial_upload_paths
+PARTIAL_UPLOAD_RE = re.compile(r'^upload_([\w-]+)\.(part|json)$')
+
+# seconds a partial upload is kept without receiving data
+PARTIAL_UPLOAD_TTL = 3600
+
+# objects received at the same time, the others wait in a queue
+MAX_CONCURRENT_UPLOADS = 2
+# objects waiting, the clients of the others are asked to retry later
+MAX_QUEUED_UPLOADS = 8
+# seconds the clients wait before retry
+UPLOAD_RETRY_AFTER = 30
+# bytes reserved for the uploads of the old clients, that don't send
+# the size, when the request doesn't have a Content-Length either
+UNKNOWN_UPLOAD_SIZE = 52428800
+# bytes received and waiting for space in the ingest pipeline, the
+# clients wait for the acknowledges with less than this in flight
+# (see utils.UPLOAD_WINDOW), the ones sending more are disconnected
+MAX_UPLOAD_BACKLOG = 2 * utils.UPLOAD_WINDOW * utils.MAX_CHUNK_SIZE
+
+# results of UploadAdmission.request
+ADMITTED, QUEUED, RETRY, NO_SPACE = range(4)
+
+# options of the permessage-deflate compression of the websockets
+COMPRESSION_OPTIONS = {'compression_level': 6, 'min_length': 128}
+# channel -> bytes saved by the compression, see add_compression_stats
+_compression_saved = {}
+
 
 class DatastoreHandler(web.StaticFileHandler):
 
+    def initialize(self, path, journal_manager):
+        web.StaticFileHandler.initialize(self, path)
+        self._jm = journal_manager
+
+    @web.asynchronous
+    def get(self, path, include_body=True):
+        # the previews and packages of the shared objects
+        # are created the first time are requested
+        match = PACKAGED_FILE_RE.match(path)
+        if match is None:
+            self._send_file(path, include_body)
+            return
+
+        prefix, object_id = match.groups()
+        kind = 'preview' if prefix == 'preview_id_' else 'package'
+        io_loop = ioloop.IOLoop.instance()
+
+        def packaged_cb(file_path):
+            io_loop.add_callback(self.async_callback(
+                self._packaged_cb, path, include_body, file_path))
+
+        GLib.idle_add(self._jm.request_package, object_id, kind,
+                      packaged_cb)
+
+    def _packaged_cb(self, path, include_body, file_path):
+        if self.request.connection.stream.closed():
+            return
+        if file_path is None:
+            raise web.HTTPError(404)
+        self._send_file(path, include_body)
+
+    def _send_file(self, path, include_body):
+        web.StaticFileHandler.get(self, path, include_body)
+        self.finish()
+
     def set_extra_headers(self, path):
         """For subclass to add extra headers to the response"""
         self.set_header("Content-Type", 'application/journal')
@@ -86,32 +159,118 @@ class IconHandler(web.RequestHandler):
         self._write_buffer.append(chunk)
 
 
-class JournalWebSocketHandler(websocket.WebSocketHandler):
+class CatalogHub(object):
+    """
+    Send the catalog updates to all the connected web clients.
+    Every update is serialized once, and the same frame is queued in all
+    the sockets with the same catalog revision. The sockets are registered
+    when they ask for the catalog and removed when closed.
+    Need be used from the IOLoop thread.
+    """
 
-    def initialize(self, instance_path, journal_manager):
-        self._instance_path = instance_path
+    def __init__(self, journal_manager, io_loop):
         self._jm = journal_manager
+        self._io_loop = io_loop
+        # socket handler -> revision of the catalog the client has
+        self._sockets = {}
         self._jm.connect('updated', self.__journal_manager_updated_cb)
 
     def __journal_manager_updated_cb(self, jm):
-        logging.error('ON JournalWebSocketHandler jm updated')
-        try:
-            f = open(os.path.join(self._instance_path, 'selected.json'))
-            logging.error(os.path.join(self._instance_path, 'selected.json'))
-            json = f.read()
-            f.close()
-            logging.error(json)
-            self.write_message(json)
-        except:
-            logging.error('Exception sending websocket msg')
+        # called in the main thread
+        self._io_loop.add_callback(self.broadcast)
+
+    def sync(self, handler, revision, epoch=None):
+        """
+        Register a socket, and send the catalog changes after revision,
+        or all the catalog if revision is None or is of other epoch
+        """
+        if epoch != self._jm.catalog_epoch:
+            revision = None
+        self._sockets[handler] = revision
+        self._send([handler])
+
+    def remove(self, handler):
+        self._sockets.pop(handler, None)
+
+    def broadcast(self):
+        self._send(self._sockets.keys())
+        logging.debug('Catalog hub: %s', self.get_stats())
+
+    def get_stats(self):
+        """
+        Return the number of subscribers, and the bytes queued to send
+        in every socket
+        """
+        queue_depths = []
+        for handler in self._sockets:
+            queue_depths.append((handler.request.remote_ip,
+                                 handler.stream.write_buffer_size()))
+        return {'subscribers': len(self._sockets),
+                'queue_depths': queue_depths}
+
+    def _send(self, handlers):
+        messages = {}
+        for handler in handlers:
+            revision = self._sockets[handler]
+            if revision not in messages:
+                messages[revision] = self._prepare_message(revision)
+            if messages[revision] is None:
+                continue
+            new_revision, message = messages[revision]
+            try:
+                handler.write_message(message)
+                self._sockets[handler] = new_revision
+            except:
+                logging.error('Exception sending websocket msg')
+                self.remove(handler)
+
+    def _prepare_message(self, revision):
+        if revision is not None:
+            changes = self._jm.get_catalog_changes(revision)
+            if changes is not None:
+                new_revision, operations = changes
+                if not operations:
+                    return None
+                return new_revision, websocket.PreparedMessage(
+                    json.dumps({'type': 'delta',
+                                'epoch': self._jm.catalog_epoch,
+                                'from': revision,
+                                'revision': new_revision,
+                                'ops': operations}))
+
+        new_revision, items_json = self._jm.get_catalog_snapshot()
+        return new_revision, websocket.PreparedMessage(
+            '{"type": "snapshot", "epoch": "%s", "revision": %d, '
+            '"items": %s}' % (self._jm.catalog_epoch, new_revision,
+                              items_json))
+
+
+class JournalWebSocketHandler(websocket.WebSocketHandler):
+
+    def initialize(self, journal_manager, hub):
+        self._jm = journal_manager
+        self._hub = hub
+
+    def get_compression_options(self):
+        return COMPRESSION_OPTIONS
 
     def open(self):
         logging.error("WebSocket opened")
 
     def on_message(self, message):
         logging.error('RECEIVED MSG: %s', message)
-        message_data = json.loads(message)
-        if message_data['type_message'] == 'DOWNLOADED':
+        self._process_message(json.loads(message), message)
+
+    def _process_message(self, message_data, message):
+        if message_data['type_message'] == 'BATCH':
+            # messages queued together by a utils.ControlChannel
+            for item in message_data['message']:
+                self._process_message(item, json.dumps(item))
+        elif message_data['type_message'] == 'SYNC':
+            # the client send the epoch and revision it has, or None
+            message = message_data['message']
+            self._hub.sync(self, message['revision'], message.get('epoch'))
+        elif message_data['type_message'] == 'DOWNLOADED':
             message = message_data['message']
             object_id = message['object_id']
             name = message['from']
@@ -122,63 +281,560 @@ class JournalWebSocketHandler(websocket.WebSocketHandler):
             self.write_message(u"You said: " + message)
 
     def on_close(self):
-        logging.error("WebSocket closed")
+        logging.error("WebSocket closed, round trip time %s",
+                      self.get_rtt_stats())
+        self._hub.remove(self)
+        add_compression_stats('catalog', self)
+
+
+class UploadAdmission(object):
+    """
+    Limit the objects received at the same time, and reserve the disk
+    space they need, keeping utils.SPACE_THRESHOLD bytes free.
+    Used only in the tornado thread.
+    """
+
+    def __init__(self, path, max_uploads=MAX_CONCURRENT_UPLOADS,
+                 max_queued=MAX_QUEUED_UPLOADS):
+        self._path = path
+        self._max_uploads = max_uploads
+        self._max_queued = max_queued
+        self._uploads = 0
+        self._reserved = 0
+        # (size, callback) of the uploads waiting
+        self._queue = deque()
+
+    def request(self, size, callback=None):
+        """
+        Request to receive an object, reserving size bytes. Return
+        ADMITTED, NO_SPACE if it doesn't fit in the disk, QUEUED if
+        callback will be called later with True when admitted, or with
+        False if there are not space, or RETRY if the queue is full or
+        there are not callback.
+        """
+        if size + utils.SPACE_THRESHOLD > utils.get_free_space(self._path):
+            return NO_SPACE
+        if not self._queue and self._can_start(size):
+            self._start(size)
+            return ADMITTED
+        if callback is not None and len(self._queue) < self._max_queued:
+            self._queue.append((size, callback))
+            return QUEUED
+        return RETRY
+
+    def cancel(self, callback):
+        """
+        Remove from the queue a request not admitted yet
+        """
+        for request in self._queue:
+            if request[1] is callback:
+                self._queue.remove(request)
+                break
+
+    def release(self, size):
+        """
+        Called when an admitted object is saved or abandoned
+        """
+        self._uploads -= 1
+        self._reserved -= size
+        while self._queue:
+            size, callback = self._queue[0]
+            if self._can_start(size):
+                self._queue.popleft()
+                self._start(size)
+                callback(True)
+            elif not self._uploads:
+                # the free space is less than when it was queued
+                self._queue.popleft()
+                callback(False)
+            else:
+                break
+        logging.debug('Upload admission: %s', self.get_stats())
+
+    def get_stats(self):
+        """
+        Return the number of objects being received, the bytes reserved
+        for them, and the number of uploads waiting
+        """
+        return {'uploads': self._uploads,
+                'reserved': self._reserved,
+                'queued': len(self._queue)}
+
+    def _can_start(self, size):
+        free_space = utils.get_free_space(self._path) - self._reserved
+        return self._uploads < self._max_uploads and \
+            free_space - size > utils.SPACE_THRESHOLD
+
+    def _start(self, size):
+        self._uploads += 1
+        self._reserved += size
 
 
 class WebSocketUploadHandler(websocket.WebSocketHandler):
+    """
+    Receive the uploads of the clients, see utils.Uploader.
+
+    The data is passed to the ingest pipeline, the bytes are
+    acknowledged after they are written to disk, then the clients
+    wait when the pipeline is behind.
 
-    def initialize(self, instance_path, journal_manager):
+    Every object is received after UploadAdmission admits it, until
+    then the server reply 'QUEUED', or 'RETRY <seconds>' and close the
+    connection, and 'NOSPACE' if the object doesn't fit in the disk.
+    """
+
+    # upload id -> handler receiving the upload
+    _active_uploads = {}
+    # upload id -> Ingest of the partial upload, until the file is closed
+    _partial_ingests = {}
+
+    def initialize(self, instance_path, journal_manager, admission):
         self._instance_path = instance_path
         self._jm = journal_manager
+        self._admission = admission
+        self._io_loop = ioloop.IOLoop.instance()
+        self._pipeline = ingest.get_ingest_pipeline()
+        self._binary = False
+        self._resumable = False
+        self._closed = False
+        self._ingest = None
+        # (ingest, data) waiting for space in the pipeline queue
+        self._backlog = deque()
+        self._backlog_bytes = 0
+        self._backlog_timeout = None
+        # True when the client sent too much without waiting, or the
+        # upload can't be saved
+        self._rejected = False
+        # resumable uploads
+        self._upload_id = None
+        self._size = None
+        # bytes reserved by the admission for the object
+        self._reserved = 0
+        self._admission_callback = None
+        # package of a journal object with the same content, when
+        # the client only needs to send the metadata
+        self._local_package_path = None
+        # (file_path, metadata, preview) of the objects received, saved
+        # in the journal all together when the connection is closed
+        # and the pipeline processed all of them
+        self._objects = []
+        self._pending_objects = 0
+        self._start_time = time.time()
+
+    def select_subprotocol(self, subprotocols):
+        # new clients send the file in binary frames, and can resume
+        # the uploads, the old ones send it base64 encoded
+        for protocol in (utils.RESUMABLE_UPLOAD_PROTOCOL,
+                         utils.BINARY_UPLOAD_PROTOCOL):
+            if protocol in subprotocols:
+                self._binary = True
+                self._resumable = \
+                    protocol == utils.RESUMABLE_UPLOAD_PROTOCOL
+                return protocol
+        return None
+
+    def get_compression_options(self):
+        return COMPRESSION_OPTIONS
 
     def open(self):
-        self._tmp_file = tempfile.NamedTemporaryFile(
-            mode='r+', dir=self._instance_path)
+        if not self._resumable:
+            # the old clients don't send the size, and can't wait
+            try:
+                size = int(self.request.headers['Content-Length'])
+            except (KeyError, ValueError):
+                size = UNKNOWN_UPLOAD_SIZE
+            reserved = size * 2
+            result = self._admission.request(reserved)
+            if result != ADMITTED:
+                if result == NO_SPACE:
+                    logging.error('Upload rejected, not enough space')
+                else:
+                    logging.error('Upload rejected, too many uploads')
+                self.close()
+                return
+            self._reserved = reserved
+            file_descriptor, package_path = tempfile.mkstemp(
+                dir=self._instance_path)
+            os.close(file_descriptor)
+            self._ingest = self._create_ingest(package_path, 'wb')
 
     def on_message(self, message):
-        self._tmp_file.write(message)
-        self._tmp_file.flush()
-        self.write_message('NEXT')
+        if self._rejected:
+            # the connection is closing
+            return
+        if self._resumable and self._upload_id is None and \
+                self._admission_callback is None:
+            self._start_upload(json.loads(message))
+            return
+        if self._local_package_path is not None:
+            self._create_from_local_data(json.loads(message))
+            return
+        if self._ingest is None:
+            return
+        if self._backlog_bytes + len(message) > MAX_UPLOAD_BACKLOG:
+            self._reject_backlog()
+            return
+
+        self._ingest.received += len(message)
+        self._put(self._ingest, message)
+        if self._size is not None and self._ingest.received >= self._size:
+            self._finish_upload()
+
+    def _create_ingest(self, package_path, mode, received=0,
+                       remove_paths=()):
+        reserved = self._reserved
+        ack_callback = lambda written: self._io_loop.add_callback(
+            lambda: self._ack(written))
+        done_callback = lambda result: self._io_loop.add_callback(
+            lambda: self._object_ready(new_ingest, result, reserved))
+        new_ingest = ingest.Ingest(self._instance_path, package_path, mode,
+                                   not self._binary, ack_callback,
+                                   done_callback, received, remove_paths)
+        return new_ingest
+
+    def _put(self, an_ingest, item):
+        if item is ingest.FINISH:
+            an_ingest.finished = True
+        self._backlog.append((an_ingest, item))
+        self._backlog_bytes += _get_item_size(item)
+        self._put_backlog()
+
+    def _put_backlog(self):
+        self._backlog_timeout = None
+        while self._backlog:
+            if not self._pipeline.put(*self._backlog[0]):
+                # try later, the data is not acknowledged until it is
+                # written, then the client stops sending
+                self._backlog_timeout = self._io_loop.add_timeout(
+                    time.time() + 0.05, self._put_backlog)
+                return
+            _an_ingest, item = self._backlog.popleft()
+            self._backlog_bytes -= _get_item_size(item)
+
+    def _reject_backlog(self):
+        # the client is not waiting for the acknowledges
+        logging.error('Upload %s closed, more than %d bytes waiting for '
+                      'the pipeline', self._upload_id, MAX_UPLOAD_BACKLOG)
+        self._rejected = True
+        if self._resumable:
+            # the client can resume it
+            self._keep_partial_upload()
+        # without the resumable protocol the package is incomplete,
+        # the pipeline discards it when the connection is closed
+        self.close()
+
+    def _ack(self, written):
+        # acknowledge all the data written, the clients send
+        # more chunks without waiting for the reply
+        if not self._closed and not self.stream.closed():
+            self.write_message('ACK %d' % written)
+
+    def _start_upload(self, header):
+        upload_id = header.get('upload_id', '')
+        if not UPLOAD_ID_RE.match(upload_id):
+            logging.error('Invalid upload id %r', upload_id)
+            self.close()
+            return
+
+        previous = self._active_uploads.get(upload_id)
+        if previous is not None:
+            # the connection was lost, but it was not closed yet
+            previous._keep_partial_upload()
+            previous.close()
+        partial_ingest = self._partial_ingests.get(upload_id)
+        if partial_ingest is not None and not partial_ingest.closed:
+            # wait until the data received before is written
+            self._io_loop.add_timeout(time.time() + 0.05,
+                                      lambda: self._start_upload(header))
+            return
+        self._partial_ingests.pop(upload_id, None)
+
+        # the package and the data extracted are in the disk together,
+        # the part of the package received before is already there
+        reserved = header['size'] * 2 - self._get_received(header)
+        self._admission_callback = \
+            lambda admitted: self._admitted(header, reserved, admitted)
+        result = self._admission.request(reserved, self._admission_callback)
+        if result == QUEUED:
+            logging.error('Upload %s queued', upload_id)
+            self.write_message('QUEUED')
+        elif result == RETRY:
+            self._admission_callback = None
+            self.write_message('RETRY %d' % UPLOAD_RETRY_AFTER)
+            self.close()
+        else:
+            self._admission_callback(result == ADMITTED)
+
+    def _admitted(self, header, reserved, admitted):
+        self._admission_callback = None
+        if not admitted:
+            logging.error('Upload %s rejected, not enough space',
+                          header['upload_id'])
+            self.write_message('NOSPACE')
+            return
+
+        upload_id = header['upload_id']
+        self._upload_id = upload_id
+        self._size = header['size']
+        self._reserved = reserved
+        self._active_uploads[upload_id] = self
+
+        if header.get('content_hash') is not None:
+            self._local_package_path = self._link_local_package(
+                header['content_hash'])
+            if self._local_package_path is not None:
+                self.write_message('HAVE')
+                return
+
+        part_path, info_path = get_partial_upload_paths(self._instance_path,
+                                                        upload_id)
+        received = self._get_received(header)
+        if received:
+            self._ingest = self._create_ingest(part_path, 'ab', received,
+                                               (info_path,))
+            logging.error('Resuming upload %s from %d', upload_id, received)
+        else:
+            with open(info_path, 'w') as info_file:
+                json.dump({'fingerprint': header['fingerprint'],
+                           'size': self._size}, info_file)
+            self._ingest = self._create_ingest(part_path, 'wb', 0,
+                                               (info_path,))
+        self._partial_ingests[upload_id] = self._ingest
+        self.write_message('OFFSET %d' % self._ingest.received)
+        if self._ingest.received >= self._size:
+            self._finish_upload()
+
+    def _get_received(self, header):
+        """
+        Return the bytes of an upload received in previous connections
+        """
+        part_path, info_path = get_partial_upload_paths(
+            self._instance_path, header['upload_id'])
+        info = {'fingerprint': header['fingerprint'], 'size': header['size']}
+        try:
+            with open(info_path) as info_file:
+                if json.load(info_file) != info:
+                    return 0
+            return os.path.getsize(part_path)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def _link_local_package(self, content_hash):
+        """
+        Link in the instance directory a cached package with the same
+        content, and return the path, or None if there are not one
+        """
+        package_path = packagecache.get_package_cache().find_content(
+            content_hash)
+        if package_path is None:
+            return None
+        local_package_path = os.path.join(
+            self._instance_path, 'local_' + self._upload_id + '.journal')
+        try:
+            if os.path.exists(local_package_path):
+                os.remove(local_package_path)
+            # the link keeps the file if is removed from the cache
+            os.link(package_path, local_package_path)
+        except OSError, e:
+            logging.error('Can\'t use the cached package %s: %s',
+                          package_path, e)
+            return None
+        logging.error('Upload %s has the content of %s', self._upload_id,
+                      package_path)
+        return local_package_path
+
+    def _create_from_local_data(self, message):
+        local_ingest = self._create_ingest(self._local_package_path, None)
+        local_ingest.metadata = message['metadata']
+        local_ingest.preview_data = base64.b64decode(message['preview'])
+        self._put(local_ingest, ingest.FINISH)
+        self._pending_objects += 1
+        del self._active_uploads[self._upload_id]
+        self._reset_upload()
+        self.write_message('DONE')
+
+    def _finish_upload(self):
+        self._put(self._ingest, ingest.FINISH)
+        self._pending_objects += 1
+        del self._active_uploads[self._upload_id]
+        del self._partial_ingests[self._upload_id]
+        self._reset_upload()
+
+    def _reset_upload(self):
+        # the client can send other object in the same connection
+        self._upload_id = None
+        self._size = None
+        self._reserved = 0
+        self._ingest = None
+        self._local_package_path = None
+
+    def _keep_partial_upload(self):
+        if self._active_uploads.get(self._upload_id) is self:
+            del self._active_uploads[self._upload_id]
+        if self._ingest is not None:
+            self._put(self._ingest, ingest.ABORT)
+            self._ingest = None
+            self._admission.release(self._reserved)
+            self._reserved = 0
+
+    def _ingest_failed(self):
+        # the package of the object being received can't be written
+        logging.error('Upload %s failed, the package can\'t be saved',
+                      self._upload_id)
+        if self._active_uploads.get(self._upload_id) is self:
+            del self._active_uploads[self._upload_id]
+        self._partial_ingests.pop(self._upload_id, None)
+        self._admission.release(self._reserved)
+        self._reset_upload()
+        self._rejected = True
+        if self._resumable and not self._closed:
+            # the client sends the object again later
+            self.write_message('RETRY %d' % UPLOAD_RETRY_AFTER)
+        self.close()
+
+    def _object_ready(self, an_ingest, result, reserved):
+        if an_ingest.failed and not an_ingest.finished:
+            # the reservation of an aborted ingest was already released
+            if an_ingest is self._ingest:
+                self._ingest_failed()
+            return
+        self._admission.release(reserved)
+        self._pending_objects -= 1
+        if result is not None:
+            self._objects.append(result)
+        if self._closed and not self._pending_objects:
+            self._create_objects()
 
     def on_close(self):
-        # save to the journal
-        # decode the file
-        self._decoded_tmp_file = tempfile.NamedTemporaryFile(
-            mode='r+', dir=self._instance_path)
-        self._tmp_file.seek(0)
-        base64.decode(self._tmp_file, self._decoded_tmp_file)
-        self._decoded_tmp_file.flush()
-
-        metadata, preview_data, file_path = \
-            utils.unpackage_ds_object(self._decoded_tmp_file.name)
-        logging.error('METADATA %s', metadata)
-
-        GLib.idle_add(self._jm.create_object, file_path, metadata,
-                      preview_data)
-        self._tmp_file.close()
-        self._decoded_tmp_file.close()
-
-
-def run_server(activity_path, activity_root, jm, port):
+        self._closed = True
+        add_compression_stats('upload', self)
+        if self._admission_callback is not None:
+            self._admission.cancel(self._admission_callback)
+        if self._resumable:
+            if self._local_package_path is not None:
+                os.remove(self._local_package_path)
+                if self._active_uploads.get(self._upload_id) is self:
+                    del self._active_uploads[self._upload_id]
+                self._admission.release(self._reserved)
+            elif self._ingest is not None:
+                # the client can resume it
+                self._keep_partial_upload()
+        elif self._ingest is not None:
+            # save to the journal
+            self._put(self._ingest, ingest.FINISH)
+            self._pending_objects += 1
+            self._ingest = None
+
+        if not self._pending_objects:
+            self._create_objects()
+
+    def _create_objects(self):
+        if not self._objects:
+            return
+        elapsed = time.time() - self._start_time
+        logging.error('Received %d objects in %.2f s, %.1f objects/s',
+                      len(self._objects), elapsed,
+                      len(self._objects) / max(elapsed, 0.001))
+        GLib.idle_add(self._jm.create_objects, self._objects)
+        self._objects = []
+
+
+def _get_item_size(item):
+    # the FINISH and ABORT markers don't count
+    if item is ingest.FINISH or item is ingest.ABORT:
+        return 0
+    return len(item)
+
+
+def add_compression_stats(channel, handler):
+    """
+    Add the bytes saved by the compression in the connection of a
+    closed handler to the totals of the channel, and log them.
+    Used in the tornado thread.
+    """
+    stats = handler.get_compression_stats()
+    if stats is None:
+        return
+    totals = _compression_saved.setdefault(
+        channel, {'sent_saved': 0, 'received_saved': 0, 'connections': 0})
+    totals['sent_saved'] += stats['sent_saved']
+    totals['received_saved'] += stats['received_saved']
+    totals['connections'] += 1
+    logging.error('Compression in the %s channel saved %d bytes sent and '
+                  '%d received, %d and %d in %d connections', channel,
+                  stats['sent_saved'], stats['received_saved'],
+                  totals['sent_saved'], totals['received_saved'],
+                  totals['connections'])
+
+
+def get_partial_upload_paths(instance_path, upload_id):
+    """
+    Return the paths of the data and the information of
+    a partial upload
+    """
+    file_name = 'upload_' + upload_id
+    return (os.path.join(instance_path, file_name + '.part'),
+            os.path.join(instance_path, file_name + '.json'))
+
+
+def expire_partial_uploads(instance_path, ttl):
+    """
+    Remove the partial uploads not modified in the last ttl seconds
+    """
+    now = time.time()
+    upload_ids = set()
+    for file_name in os.listdir(instance_path):
+        match = PARTIAL_UPLOAD_RE.match(file_name)
+        if match is not None:
+            upload_ids.add(match.group(1))
+
+    for upload_id in upload_ids:
+        partial_ingest = WebSocketUploadHandler._partial_ingests.get(
+            upload_id)
+        if upload_id in WebSocketUploadHandler._active_uploads or \
+                (partial_ingest is not None and not partial_ingest.closed):
+            continue
+        paths = [path for path in
+                 get_partial_upload_paths(instance_path, upload_id)
+                 if os.path.exists(path)]
+        if now - max(os.path.getmtime(path) for path in paths) > ttl:
+            logging.error('Removing expired upload %s', upload_id)
+            WebSocketUploadHandler._partial_ingests.pop(upload_id, None)
+            for path in paths:
+                os.remove(path)
+
+
+def run_server(activity_path, activity_root, jm, port,
+               upload_ttl=PARTIAL_UPLOAD_TTL):
 
     from threading import Thread
     io_loop = ioloop.IOLoop.instance()
 
     static_path = os.path.join(activity_path, 'web')
     instance_path = os.path.join(activity_root, 'instance')
+    hub = CatalogHub(jm, io_loop)
+    admission = UploadAdmission(instance_path)
 
     application = web.Application(
         [
             (r"/web/(.*)", web.StaticFileHandler, {"path": static_path}),
             (r"/icon/(.*)", IconHandler, {"path": static_path}),
-            (r"/datastore/(.*)", DatastoreHandler, {"path": instance_path}),
+            (r"/datastore/(.*)", DatastoreHandler,
+                {"path": instance_path, "journal_manager": jm}),
             (r"/websocket", JournalWebSocketHandler,
-                {"instance_path": instance_path, "journal_manager": jm}),
+                {"journal_manager": jm, "hub": hub}),
             (r"/websocket/upload", WebSocketUploadHandler,
-                {"instance_path": instance_path, "journal_manager": jm})
-        ])
+                {"instance_path": instance_path, "journal_manager": jm,
+                 "admission": admission})
+        ],
+        websocket_ping_interval=utils.KEEPALIVE_INTERVAL)
     http_server = httpserver.HTTPServer(application)
     http_server.listen(port)
+    # check the partial uploads every tenth of the ttl
+    expire_uploads = ioloop.PeriodicCallback(
+        lambda: expire_partial_uploads(instance_path, upload_ttl),
+        upload_ttl * 100, io_loop=io_loop)
+    expire_uploads.start()
     tornado_looop = Thread(target=io_loop.start)
     tornado_looop.setDaemon(True)
     tornado_looop.start()
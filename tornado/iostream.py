@@ -257,6 +257,10 @@ class IOStream(object):
         """Returns true if the stream has been closed."""
         return self.socket is None
 
+    def write_buffer_size(self):
+        """Returns the number of bytes waiting to be written to the stream."""
+        return sum(len(chunk) for chunk in self._write_buffer)
+
     def _handle_events(self, fd, events):
         if not self.socket:
             logging.warning("Got events for closed stream %d", fd)
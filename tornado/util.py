@@ -1,5 +1,7 @@
 """Miscellaneous utility functions."""
 
+import zlib
+
 class ObjectDict(dict):
     """Makes a dictionary behave like an object."""
     def __getattr__(self, name):
@@ -42,6 +44,250 @@ else:
         return s
     bytes_type = str
 
+# _XOR_TABLES[m] is a translation table xoring every byte with m
+_XOR_TABLES = [bytes(bytearray(byte ^ mask_byte for byte in range(256)))
+               for mask_byte in range(256)]
+
+
+def _websocket_mask_python(mask, data):
+    """Websocket masking function.
+
+    `mask` is a `bytes` object of length 4; `data` is a `bytes`,
+    `bytearray` or `memoryview` object of any length.  Returns a `bytes`
+    object of the same length as `data` with the mask applied as
+    specified in section 5.3 of RFC 6455.
+
+    Every fourth byte is xored with the same mask byte, then the bytes
+    in each of the four positions are translated at once with
+    `bytes.translate`, instead of a python loop for every byte.
+
+    The result is the same of the loop xoring every byte, and of the
+    numpy version when it is in use, with any length of the data:
+
+    >>> import array
+    >>> def mask_per_byte(mask, data):
+    ...     mask = array.array("B", mask)
+    ...     unmasked = array.array("B", data)
+    ...     for i in range(len(unmasked)):
+    ...         unmasked[i] = unmasked[i] ^ mask[i % 4]
+    ...     return unmasked.tostring()
+    >>> mask = b("\\x01\\x82\\xfe\\x7f")
+    >>> payloads = [bytes_type(bytearray(range(length)))
+    ...             for length in (0, 1, 2, 3, 4, 5, 6, 7, 125, 126, 255)]
+    >>> all(function(mask, data) == mask_per_byte(mask, data)
+    ...     for function in (_websocket_mask_python, websocket_mask)
+    ...     for data in payloads)
+    True
+    >>> all(function(mask, wrapper(data)) == mask_per_byte(mask, data)
+    ...     for function in (_websocket_mask_python, websocket_mask)
+    ...     for wrapper in (bytearray, memoryview)
+    ...     for data in payloads)
+    True
+    """
+    if isinstance(data, memoryview):
+        # memoryview doesn't support the extended slices
+        data = data.tobytes()
+    masked = bytearray(data)
+    mask_bytes = bytearray(mask)
+    for i in range(4):
+        masked[i::4] = data[i::4].translate(_XOR_TABLES[mask_bytes[i]])
+    return bytes(masked)
+
+
+def _websocket_mask_numpy(mask, data):
+    """Websocket masking function using numpy, see _websocket_mask_python.
+
+    The data is xored as 32 bits words, and the remaining bytes
+    one by one.
+    """
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    length = len(data)
+    words = length // 4
+    masked = (numpy.frombuffer(data, dtype=numpy.uint32, count=words) ^
+              numpy.frombuffer(mask, dtype=numpy.uint32)[0]).tostring()
+    if length % 4:
+        tail = numpy.frombuffer(data, dtype=numpy.uint8, offset=words * 4)
+        masked += (tail ^ numpy.frombuffer(mask[:length % 4],
+                                           dtype=numpy.uint8)).tostring()
+    return masked
+
+
+try:
+    import numpy
+except ImportError:
+    websocket_mask = _websocket_mask_python
+else:
+    websocket_mask = _websocket_mask_numpy
+
+
+# tail of the deflate data of every message, removed by the sender
+# of a message compressed with the permessage-deflate extension
+_DEFLATE_TAIL = b("\x00\x00\xff\xff")
+# messages shorter than this are not compressed by default
+DEFLATE_MIN_LENGTH = 128
+# messages not compressed after a compression that doesn't pay
+_DEFLATE_MAX_SKIP = 64
+
+
+def parse_websocket_extensions(header):
+    """Parses a ``Sec-WebSocket-Extensions`` header.
+
+    Returns a list of ``(name, params)`` tuples, ``params`` is a dict
+    with ``None`` as value for the parameters without a value.
+
+    >>> parse_websocket_extensions("permessage-deflate; "
+    ...     "client_max_window_bits, x-foo")
+    [('permessage-deflate', {'client_max_window_bits': None}), ('x-foo', {})]
+    """
+    extensions = []
+    for extension in header.split(","):
+        parts = [part.strip() for part in extension.split(";")]
+        if not parts[0]:
+            continue
+        params = {}
+        for param in parts[1:]:
+            if not param:
+                continue
+            if "=" in param:
+                key, value = param.split("=", 1)
+                params[key.strip()] = value.strip().strip('"')
+            else:
+                params[param] = None
+        extensions.append((parts[0], params))
+    return extensions
+
+
+class PerMessageCompressor(object):
+    """Compresses messages for the permessage-deflate extension (RFC 7692).
+
+    If ``persistent`` is true the compression context is kept between
+    messages (context takeover), if not every message is compressed
+    alone.  Messages shorter than ``min_length``, or not shorter when
+    compressed, are sent as they are; after a message that doesn't
+    compress, the next ones are not even tried, skipping twice as many
+    every time, so already compressed data costs little.
+    """
+    def __init__(self, persistent=False, max_wbits=15, level=6,
+                 min_length=DEFLATE_MIN_LENGTH):
+        self.persistent = persistent
+        self.key = (persistent, max_wbits, level, min_length)
+        self._wbits = max(max_wbits, 9)
+        self._level = level
+        self._min_length = min_length
+        self._compressor = None
+        self._skip = 0
+        self._skipped = 0
+
+    def compress(self, data):
+        """Returns the payload of the compressed message, or ``None``
+        if the message is sent without compression.
+        """
+        if len(data) < self._min_length:
+            return None
+        if self._skipped < self._skip:
+            self._skipped += 1
+            return None
+        compressor = self._compressor
+        if compressor is None:
+            compressor = zlib.compressobj(self._level, zlib.DEFLATED,
+                                          -self._wbits)
+        if self.persistent:
+            # the context is restored if the message is not compressed
+            self._compressor = compressor.copy()
+        compressed = compressor.compress(data) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        compressed = compressed[:-len(_DEFLATE_TAIL)]
+        if len(compressed) >= len(data):
+            self._skip = min(max(self._skip * 2, 1), _DEFLATE_MAX_SKIP)
+            self._skipped = 0
+            return None
+        if self.persistent:
+            self._compressor = compressor
+        self._skip = 0
+        return compressed
+
+
+class PerMessageDecompressor(object):
+    """Decompresses messages of the permessage-deflate extension.
+
+    The context is kept between messages if ``persistent`` is true.
+    ``ValueError`` is raised if a message (or a part of it, when
+    decompressed in parts) is longer than ``max_length`` when
+    decompressed.
+    """
+    def __init__(self, persistent=True, max_length=None):
+        self.persistent = persistent
+        self._max_length = max_length or 0
+        self._decompressor = None
+
+    def decompress(self, data, final=True):
+        """Decompresses a message, or a part of it if ``final`` is
+        false, then the next parts are passed in the next calls.
+        """
+        decompressor = self._decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-15)
+        if final:
+            data += _DEFLATE_TAIL
+        data = decompressor.decompress(data, self._max_length)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed message too long")
+        if self.persistent or not final:
+            self._decompressor = decompressor
+        else:
+            self._decompressor = None
+        return data
+
+
+class RttEstimator(object):
+    """Smoothed round trip time and its variation, computed as in
+    RFC 6298 from the samples passed to `update`.
+
+    >>> estimator = RttEstimator()
+    >>> estimator.update(0.2)
+    >>> estimator.update(0.4)
+    >>> round(estimator.srtt, 3), round(estimator.rttvar, 3)
+    (0.225, 0.125)
+    """
+    def __init__(self):
+        self.rtt = None
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rtt = rtt
+        self.samples += 1
+
+    def get_stats(self):
+        """Returns a dict with the last round trip time, the smoothed
+        one, its variation, the retransmission timeout (``srtt + 4 *
+        rttvar``) and the number of samples.  The times are ``None``
+        without samples.
+        """
+        rto = None
+        if self.srtt is not None:
+            rto = self.srtt + 4 * self.rttvar
+        return {"rtt": self.rtt, "srtt": self.srtt, "rttvar": self.rttvar,
+                "rto": rto, "samples": self.samples}
+
+
+def get_ping_timeout(ping_interval, ping_timeout=None):
+    """Returns the seconds to wait for the pong of a keepalive ping,
+    ``ping_timeout`` or by default three intervals, at least 30 seconds.
+    """
+    if ping_timeout is not None:
+        return ping_timeout
+    return max(3 * ping_interval, 30)
+
+
 def doctests():
     import doctest
     return doctest.DocTestSuite()
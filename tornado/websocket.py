@@ -18,17 +18,20 @@ communication between the browser and server.
 """
 # Author: Jacob Kristhammar, 2010
 
-import array
 import functools
 import hashlib
 import logging
 import struct
 import time
 import base64
+import zlib
 import tornado.escape
 import tornado.web
 
-from tornado.util import bytes_type, b
+from tornado.util import bytes_type, b, websocket_mask
+from tornado.util import parse_websocket_extensions
+from tornado.util import PerMessageCompressor, PerMessageDecompressor
+from tornado.util import RttEstimator, get_ping_timeout
 
 class WebSocketHandler(tornado.web.RequestHandler):
     """Subclass this class to create a basic WebSocket handler.
@@ -78,6 +81,8 @@ class WebSocketHandler(tornado.web.RequestHandler):
                                             **kwargs)
         self.stream = request.connection.stream
         self.ws_connection = None
+        self._compression_stats = None
+        self._rtt_stats = None
 
     def _execute(self, transforms, *args, **kwargs):
         self.open_args = args
@@ -135,7 +140,15 @@ class WebSocketHandler(tornado.web.RequestHandler):
         encoded as json).  If the ``binary`` argument is false, the
         message will be sent as utf8; in binary mode any byte string
         is allowed.
+
+        To send the same message to many clients, create a
+        `PreparedMessage` once and pass it here, so it is encoded and
+        framed only once for every protocol version.
         """
+        if isinstance(message, PreparedMessage):
+            self.ws_connection.write_frame(
+                *message.get_frame(self.ws_connection))
+            return
         if isinstance(message, dict):
             message = tornado.escape.json_encode(message)
         self.ws_connection.write_message(message, binary=binary)
@@ -153,6 +166,55 @@ class WebSocketHandler(tornado.web.RequestHandler):
         """
         return None
 
+    def get_compression_options(self):
+        """Override to return a dict to enable the permessage-deflate
+        extension, if the client supports it.  ``None`` (the default)
+        disables it.
+
+        The dict may contain ``compression_level`` (the zlib level,
+        6 by default) and ``min_length`` (messages shorter are not
+        compressed).  The messages sent are always compressed without
+        context takeover, so a `PreparedMessage` is compressed only
+        once for all the clients.
+        """
+        return None
+
+    def get_compression_stats(self):
+        """Returns a dict with the bytes saved by the compression in
+        the messages sent and received, ``None`` if the connection is
+        not compressed.  Available in `on_close` too.
+        """
+        if self.ws_connection is None:
+            return self._compression_stats
+        return self.ws_connection.get_compression_stats()
+
+    @property
+    def ping_interval(self):
+        """Seconds between the keepalive pings sent to the client, from
+        the ``websocket_ping_interval`` application setting.  ``None``
+        (the default) disables the pings.
+        """
+        return self.settings.get("websocket_ping_interval", None)
+
+    @property
+    def ping_timeout(self):
+        """Seconds to wait for the pong of a ping before closing the
+        connection, from the ``websocket_ping_timeout`` application
+        setting, by default three ping intervals, at least 30 seconds.
+        """
+        return get_ping_timeout(self.ping_interval,
+                                self.settings.get("websocket_ping_timeout"))
+
+    def get_rtt_stats(self):
+        """Returns a dict with the round trip times measured with the
+        keepalive pings, see `tornado.util.RttEstimator.get_stats`, or
+        ``None`` if the connection doesn't send pings.  Available in
+        `on_close` too.
+        """
+        if self.ws_connection is None:
+            return self._rtt_stats
+        return self.ws_connection.get_rtt_stats()
+
     def open(self):
         """Invoked when a new WebSocket is opened.
 
@@ -162,6 +224,10 @@ class WebSocketHandler(tornado.web.RequestHandler):
         """
         pass
 
+    # set to True in a subclass to receive the data messages in parts,
+    # as they arrive, with on_message_chunk instead of on_message
+    stream_messages = False
+
     def on_message(self, message):
         """Handle incoming messages on the WebSocket
 
@@ -169,6 +235,18 @@ class WebSocketHandler(tornado.web.RequestHandler):
         """
         raise NotImplementedError
 
+    def on_message_chunk(self, data, final, binary):
+        """Handle the data of incoming messages as it arrives.
+
+        Called instead of `on_message` if ``stream_messages`` is true,
+        so big messages are never kept in memory.  ``data`` is the next
+        part of the message, as a byte string (text messages are not
+        decoded), ``final`` is true in the last part of every message
+        (then ``data`` may be empty), and ``binary`` is true for binary
+        messages.  Supported only by the final version of the protocol.
+        """
+        raise NotImplementedError
+
     def on_close(self):
         """Invoked when the WebSocket is closed."""
         pass
@@ -222,6 +300,9 @@ class WebSocketHandler(tornado.web.RequestHandler):
     def on_connection_close(self):
         if self.ws_connection:
             self.ws_connection.on_connection_close()
+            self._compression_stats = \
+                self.ws_connection.get_compression_stats()
+            self._rtt_stats = self.ws_connection.get_rtt_stats()
             self.ws_connection = None
             self.on_close()
 
@@ -231,6 +312,32 @@ for method in ["write", "redirect", "set_header", "send_error", "set_cookie",
     setattr(WebSocketHandler, method, WebSocketHandler._not_supported)
 
 
+class PreparedMessage(object):
+    """A message to be sent to several WebSocket clients.
+
+    The frame is built only the first time it is sent with each
+    protocol version and compression, and the same bytes are written
+    to all the streams.
+    """
+    def __init__(self, message, binary=False):
+        if isinstance(message, dict):
+            message = tornado.escape.json_encode(message)
+        self.message = tornado.escape.utf8(message)
+        self.binary = binary
+        self._frames = {}
+
+    def get_frame(self, protocol):
+        """Returns a ``(frame, saved)`` tuple, see
+        `WebSocketProtocol.prepare_message`.
+        """
+        key = protocol.get_frame_key()
+        frame = self._frames.get(key)
+        if frame is None:
+            frame = protocol.prepare_message(self.message, binary=self.binary)
+            self._frames[key] = frame
+        return frame
+
+
 class WebSocketProtocol(object):
     """Base class for WebSocket protocol versions.
     """
@@ -261,6 +368,28 @@ class WebSocketProtocol(object):
     def on_connection_close(self):
         self._abort()
 
+    def get_frame_key(self):
+        """Returns a key of the format of the frames of this connection,
+        the same for the connections that can share the frames.
+        """
+        return self.__class__
+
+    def prepare_message(self, message, binary=False):
+        """Returns a ``(frame, saved)`` tuple with the frame to send the
+        given message, and the bytes saved compressing it.
+        """
+        return self.format_message(message, binary=binary), 0
+
+    def get_compression_stats(self):
+        return None
+
+    def get_rtt_stats(self):
+        return None
+
+    def write_frame(self, frame, saved=0):
+        """Writes a frame built with `prepare_message`."""
+        self.stream.write(frame)
+
     def _abort(self):
         """Instantly aborts the WebSocket connection by closing the socket"""
         self.client_terminated = True
@@ -406,15 +535,19 @@ class WebSocketProtocol76(WebSocketProtocol):
         self.client_terminated = True
         self.close()
 
-    def write_message(self, message, binary=False):
-        """Sends the given message to the client of this Web Socket."""
+    def format_message(self, message, binary=False):
+        """Returns the frame to send the given message."""
         if binary:
             raise ValueError(
                 "Binary messages not supported by this version of websockets")
         if isinstance(message, unicode):
             message = message.encode("utf-8")
         assert isinstance(message, bytes_type)
-        self.stream.write(b("\x00") + message + b("\xff"))
+        return b("\x00") + message + b("\xff")
+
+    def write_message(self, message, binary=False):
+        """Sends the given message to the client of this Web Socket."""
+        self.stream.write(self.format_message(message, binary=binary))
 
     def close(self):
         """Closes the WebSocket connection."""
@@ -446,7 +579,26 @@ class WebSocketProtocol13(WebSocketProtocol):
         self._frame_length = None
         self._fragmented_message_buffer = None
         self._fragmented_message_opcode = None
+        self._fragmented_message_compressed = False
+        self._frame_compressed = False
+        # data messages delivered in parts, see
+        # WebSocketHandler.stream_messages
+        self._streaming = handler.stream_messages
+        self._streamed_message_opcode = None
+        self._streamed_message_compressed = False
+        self._frame_offset = 0
+        # keepalive pings, the payload and the time of the ping
+        # waiting for the pong
+        self._rtt = None
+        self._ping_payload = None
+        self._ping_time = None
+        self._ping_timeout = None
         self._waiting = None
+        self._compressor = None
+        self._decompressor = None
+        self._extension_header = ''
+        self._sent_saved = 0
+        self._received_saved = 0
 
     def accept_connection(self):
         try:
@@ -484,22 +636,119 @@ class WebSocketProtocol13(WebSocketProtocol):
                 assert selected in subprotocols
                 subprotocol_header = "Sec-WebSocket-Protocol: %s\r\n" % selected
 
+        options = self.handler.get_compression_options()
+        if options is not None:
+            extensions = parse_websocket_extensions(
+                self.request.headers.get("Sec-WebSocket-Extensions", ''))
+            for name, params in extensions:
+                if name == "permessage-deflate" and \
+                        self._create_compressors(params, options):
+                    break
+
         self.stream.write(tornado.escape.utf8(
             "HTTP/1.1 101 Switching Protocols\r\n"
             "Upgrade: websocket\r\n"
             "Connection: Upgrade\r\n"
             "Sec-WebSocket-Accept: %s\r\n"
-            "%s"
-            "\r\n" % (self._challenge_response(), subprotocol_header)))
+            "%s%s"
+            "\r\n" % (self._challenge_response(), subprotocol_header,
+                       self._extension_header)))
 
         self.async_callback(self.handler.open)(*self.handler.open_args, **self.handler.open_kwargs)
+        if self.handler.ping_interval and not self.stream.closed():
+            self._rtt = RttEstimator()
+            self._schedule_ping()
         self._receive_frame()
 
-    def _write_frame(self, fin, opcode, data):
+    def _create_compressors(self, params, options):
+        """Accepts a permessage-deflate offer if its parameters are
+        supported, the messages sent are compressed without context
+        takeover.  Returns False to decline the offer.
+        """
+        response = ["permessage-deflate", "server_no_context_takeover"]
+        max_wbits = 15
+        for key, value in params.items():
+            if key == "server_max_window_bits":
+                try:
+                    max_wbits = int(value)
+                except (TypeError, ValueError):
+                    return False
+                if not 8 <= max_wbits <= 15:
+                    return False
+                response.append("server_max_window_bits=%d" % max_wbits)
+            elif key not in ("server_no_context_takeover",
+                             "client_no_context_takeover",
+                             "client_max_window_bits"):
+                return False
+        self._compressor = PerMessageCompressor(
+            persistent=False, max_wbits=max_wbits,
+            level=options.get("compression_level", 6),
+            min_length=options.get("min_length", 128))
+        self._decompressor = PerMessageDecompressor(
+            persistent="client_no_context_takeover" not in params,
+            max_length=self.stream.max_buffer_size)
+        self._extension_header = "Sec-WebSocket-Extensions: %s\r\n" % \
+            "; ".join(response)
+        return True
+
+    def _schedule_ping(self, delay=None):
+        if delay is None:
+            delay = self.handler.ping_interval
+        self._ping_timeout = self.stream.io_loop.add_timeout(
+            time.time() + delay, self._send_ping)
+
+    def _cancel_ping(self):
+        if self._ping_timeout is not None:
+            self.stream.io_loop.remove_timeout(self._ping_timeout)
+            self._ping_timeout = None
+
+    def _abort(self):
+        self._cancel_ping()
+        WebSocketProtocol._abort(self)
+
+    def _send_ping(self):
+        self._ping_timeout = None
+        if self.client_terminated or self.server_terminated or \
+                self.stream.closed():
+            return
+        now = time.time()
+        if self._ping_time is None:
+            self._ping_payload = struct.pack("!d", now)
+            self._ping_time = now
+            self._write_frame(True, 0x9, self._ping_payload)
+        elif now - self._ping_time >= self.handler.ping_timeout:
+            logging.debug("No pong received from %s, closing",
+                          self.request.remote_ip)
+            self._abort()
+            return
+        # wake up for the next ping, or when the pong is late
+        self._schedule_ping(min(self.handler.ping_interval,
+                                self._ping_time + self.handler.ping_timeout -
+                                now))
+
+    def get_rtt_stats(self):
+        if self._rtt is None:
+            return None
+        return self._rtt.get_stats()
+
+    def get_frame_key(self):
+        if self._compressor is None:
+            return self.__class__
+        return self.__class__, self._compressor.key
+
+    def get_compression_stats(self):
+        if self._compressor is None:
+            return None
+        return {"sent_saved": self._sent_saved,
+                "received_saved": self._received_saved}
+
+    def _format_frame(self, fin, opcode, data, rsv1=False):
         if fin:
             finbit = 0x80
         else:
             finbit = 0
+        if rsv1:
+            finbit |= 0x40
         frame = struct.pack("B", finbit | opcode)
         l = len(data)
         if l < 126:
@@ -509,17 +758,37 @@ class WebSocketProtocol13(WebSocketProtocol):
         else:
             frame += struct.pack("!BQ", 127, l)
         frame += data
-        self.stream.write(frame)
+        return frame
 
-    def write_message(self, message, binary=False):
-        """Sends the given message to the client of this Web Socket."""
+    def _write_frame(self, fin, opcode, data):
+        self.stream.write(self._format_frame(fin, opcode, data))
+
+    def format_message(self, message, binary=False):
+        """Returns the frame to send the given message."""
+        return self.prepare_message(message, binary=binary)[0]
+
+    def prepare_message(self, message, binary=False):
         if binary:
             opcode = 0x2
         else:
             opcode = 0x1
         message = tornado.escape.utf8(message)
         assert isinstance(message, bytes_type)
-        self._write_frame(True, opcode, message)
+        if self._compressor is not None:
+            compressed = self._compressor.compress(message)
+            if compressed is not None:
+                return (self._format_frame(True, opcode, compressed,
+                                           rsv1=True),
+                        len(message) - len(compressed))
+        return self._format_frame(True, opcode, message), 0
+
+    def write_frame(self, frame, saved=0):
+        self._sent_saved += saved
+        self.stream.write(frame)
+
+    def write_message(self, message, binary=False):
+        """Sends the given message to the client of this Web Socket."""
+        self.write_frame(*self.prepare_message(message, binary=binary))
 
     def _receive_frame(self):
         self.stream.read_bytes(2, self._on_frame_start)
@@ -530,6 +799,11 @@ class WebSocketProtocol13(WebSocketProtocol):
         reserved_bits = header & 0x70
         self._frame_opcode = header & 0xf
         self._frame_opcode_is_control = self._frame_opcode & 0x8
+        # RSV1 marks the first frame of a compressed message
+        self._frame_compressed = bool(reserved_bits & 0x40)
+        if self._frame_compressed and self._decompressor is not None and \
+                self._frame_opcode in (0x1, 0x2):
+            reserved_bits &= ~0x40
         if reserved_bits:
             # client is using as-yet-undefined extensions; abort
             self._abort()
@@ -560,13 +834,74 @@ class WebSocketProtocol13(WebSocketProtocol):
         self.stream.read_bytes(4, self._on_masking_key);
 
     def _on_masking_key(self, data):
-        self._frame_mask = array.array("B", data)
-        self.stream.read_bytes(self._frame_length, self._on_frame_data)
+        self._frame_mask = data
+        if self._streaming and not self._frame_opcode_is_control:
+            self._start_streamed_frame()
+        else:
+            self.stream.read_bytes(self._frame_length, self._on_frame_data)
+
+    def _start_streamed_frame(self):
+        if self._frame_opcode == 0:  # continuation frame
+            if self._streamed_message_opcode is None:
+                # nothing to continue
+                self._abort()
+                return
+        else:  # start of new data message
+            if self._streamed_message_opcode is not None:
+                # can't start new message until the old one is finished
+                self._abort()
+                return
+            self._streamed_message_opcode = self._frame_opcode
+            self._streamed_message_compressed = self._frame_compressed
+        self._frame_offset = 0
+        self.stream.read_bytes(self._frame_length, self._on_streamed_frame_end,
+                               streaming_callback=self._on_streamed_data)
+
+    def _on_streamed_data(self, data):
+        # the data of a frame can arrive in parts of any length,
+        # the mask is rotated to the offset of every part
+        offset = self._frame_offset % 4
+        self._frame_offset += len(data)
+        data = websocket_mask(
+            self._frame_mask[offset:] + self._frame_mask[:offset], data)
+        if self._streamed_message_compressed:
+            compressed_length = len(data)
+            data = self._decompress(data, final=False)
+            if data is None:
+                return
+            self._received_saved += len(data) - compressed_length
+        if data:
+            self._deliver_chunk(data, False)
+
+    def _on_streamed_frame_end(self, data):
+        if self._final_frame:
+            data = b("")
+            if self._streamed_message_compressed:
+                data = self._decompress(data, final=True)
+                if data is None:
+                    return
+                self._received_saved += len(data)
+            self._deliver_chunk(data, True)
+            self._streamed_message_opcode = None
+        if not self.client_terminated:
+            self._receive_frame()
+
+    def _deliver_chunk(self, data, final):
+        if self.client_terminated:
+            return
+        self.async_callback(self.handler.on_message_chunk)(
+            data, final, self._streamed_message_opcode == 0x2)
+
+    def _decompress(self, data, final=True):
+        try:
+            return self._decompressor.decompress(data, final=final)
+        except (ValueError, zlib.error):
+            logging.debug("Invalid compressed WebSocket message")
+            self._abort()
+            return None
 
     def _on_frame_data(self, data):
-        unmasked = array.array("B", data)
-        for i in xrange(len(data)):
-            unmasked[i] = unmasked[i] ^ self._frame_mask[i % 4]
+        unmasked = websocket_mask(self._frame_mask, data)
 
         if self._frame_opcode_is_control:
             # control frames may be interleaved with a series of fragmented
@@ -582,11 +917,12 @@ class WebSocketProtocol13(WebSocketProtocol):
                 # nothing to continue
                 self._abort()
                 return
-            self._fragmented_message_buffer += unmasked
+            self._fragmented_message_buffer.append(unmasked)
             if self._final_frame:
                 opcode = self._fragmented_message_opcode
-                unmasked = self._fragmented_message_buffer
+                unmasked = b("").join(self._fragmented_message_buffer)
                 self._fragmented_message_buffer = None
+                self._frame_compressed = self._fragmented_message_compressed
         else:  # start of new data message
             if self._fragmented_message_buffer is not None:
                 # can't start new message until the old one is finished
@@ -596,10 +932,17 @@ class WebSocketProtocol13(WebSocketProtocol):
                 opcode = self._frame_opcode
             else:
                 self._fragmented_message_opcode = self._frame_opcode
-                self._fragmented_message_buffer = unmasked
+                self._fragmented_message_buffer = [unmasked]
+                self._fragmented_message_compressed = self._frame_compressed
 
         if self._final_frame:
-            self._handle_message(opcode, unmasked.tostring())
+            if self._frame_compressed and not self._frame_opcode_is_control:
+                data = self._decompress(unmasked)
+                if data is None:
+                    return
+                self._received_saved += len(data) - len(unmasked)
+                unmasked = data
+            self._handle_message(opcode, unmasked)
 
         if not self.client_terminated:
             self._receive_frame()
@@ -628,7 +971,10 @@ class WebSocketProtocol13(WebSocketProtocol):
             self._write_frame(True, 0xA, data)
         elif opcode == 0xA:
             # Pong
-            pass
+            if self._ping_payload is not None and data == self._ping_payload:
+                self._rtt.update(time.time() - self._ping_time)
+                self._ping_payload = None
+                self._ping_time = None
         else:
             self._abort()
 
@@ -638,6 +984,7 @@ class WebSocketProtocol13(WebSocketProtocol):
             if not self.stream.closed():
                 self._write_frame(True, 0x8, b(""))
             self.server_terminated = True
+        self._cancel_ping()
         if self.client_terminated:
             if self._waiting is not None:
                 self.stream.io_loop.remove_timeout(self._waiting)
@@ -22,60 +22,746 @@ import json
 import dbus
 from zipfile import ZipFile
 import logging
+import itertools
+import functools
+import multiprocessing
+import time
+import uuid
+import hashlib
+from collections import deque
+import Queue
 from threading import Thread
+from threading import Lock
 
 import websocket
-import tempfile
 
 from sugar3 import profile
 
 CHUNK_SIZE = 2048
 
+# the uploads keep UPLOAD_WINDOW chunks sent and not acknowledged by the
+# server, the size of the chunks is adapted to the measured throughput
+# and round trip time between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE
+UPLOAD_WINDOW = 8
+MIN_CHUNK_SIZE = CHUNK_SIZE
+MAX_CHUNK_SIZE = 262144
+# the chunk size is reduced if the round trip time is longer, in seconds
+MAX_UPLOAD_RTT = 1.0
+# seconds between the progress signals of the uploads,
+# and between the progress messages in the log
+PROGRESS_INTERVAL = 0.5
+PROGRESS_LOG_INTERVAL = 5
+
+# WebSocket subprotocol used to upload the files in binary frames,
+# the clients not requesting it send the files base64 encoded
+BINARY_UPLOAD_PROTOCOL = 'journal-upload-binary'
+# binary uploads starting with a header with the upload id, the server
+# keep the partial uploads and the clients resume them after reconnecting
+RESUMABLE_UPLOAD_PROTOCOL = 'journal-upload-resumable'
+# times an upload is resumed after losing the connection, or retried
+# when the server is busy, and seconds to wait before the first attempt
+# after losing the connection (doubled in every attempt)
+UPLOAD_RETRIES = 5
+UPLOAD_RETRY_DELAY = 2
+
+# messages sent to the server within CONTROL_BATCH_DELAY seconds are
+# sent together, up to CONTROL_BATCH_SIZE in a frame, see ControlChannel
+CONTROL_BATCH_DELAY = 0.05
+CONTROL_BATCH_SIZE = 50
+# seconds to wait before reconnecting a ControlChannel,
+# doubled after every failed attempt up to CONTROL_MAX_RETRY_DELAY
+CONTROL_RETRY_DELAY = 2
+CONTROL_MAX_RETRY_DELAY = 60
+
+# seconds between the keepalive pings of the websockets, the connection
+# is closed if a pong doesn't arrive in three intervals
+KEEPALIVE_INTERVAL = 20
+
+# free space (in bytes) left in the disk by the downloads and uploads
+SPACE_THRESHOLD = 52428800
+
+# priorities of the jobs in a WorkerPool, lower values run first
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
 
 class Uploader(GObject.GObject):
+    """
+    Send files to the WebSocketUploadHandler of the server.
+
+    The connection runs in the GLib main loop, or in the loop given,
+    see websocket.AsyncWebSocketApp.
+
+    Up to UPLOAD_WINDOW chunks are sent without waiting for a reply,
+    the server acknowledges the data received with a 'ACK <bytes>'
+    message, where bytes is the total received. Servers not sending
+    the total reply 'NEXT' to every chunk.
 
-    __gsignals__ = {'uploaded': (GObject.SignalFlags.RUN_FIRST, None, ([]))}
+    With the resumable protocol the first message is a header with the
+    upload id, the fingerprint and the size of the file, the server
+    reply 'OFFSET <bytes>' with the data it already has, and the upload
+    continue from there. If the connection is lost, the uploader
+    reconnects and resume the upload.
 
-    def __init__(self, file_path, url):
+    The header has the hash of the content of the journal object too,
+    if the server has an object with the same content, it reply 'HAVE',
+    the uploader send only the metadata and the preview, and the
+    server reply 'DONE' when the object is created.
+
+    More files can be added with add() while the upload is running,
+    with the resumable protocol they are sent in the same connection,
+    every one after his header.
+
+    The server can reply to the header 'QUEUED' and start the upload
+    later, 'RETRY <seconds>' to reconnect after that time, or 'NOSPACE'
+    if the file doesn't fit in the disk, then the file is skipped.
+
+    The content hash of every file is calculated in the WorkerPool
+    given, or the shared one, before his upload starts.
+
+    The 'progress' signal is emitted every PROGRESS_INTERVAL seconds
+    with the dictionary returned by get_progress.
+    """
+
+    __gsignals__ = {'uploaded': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+                    'progress': (GObject.SignalFlags.RUN_FIRST, None,
+                                 ([object]))}
+
+    def __init__(self, file_path, url, fingerprint=None, loop=None,
+                 workers=None):
         GObject.GObject.__init__(self)
         logging.error('websocket url %s', url)
-        # base64 encode the file
-        self._file = tempfile.TemporaryFile(mode='r+')
-        base64.encode(open(file_path, 'r'), self._file)
-        self._file.seek(0)
-
-        self._ws = websocket.WebSocketApp(url,
-                                          on_open=self._on_open,
-                                          on_message=self._on_message,
-                                          on_error=self._on_error,
-                                          on_close=self._on_close)
-        self._chunk = str(self._file.read(CHUNK_SIZE))
+        # (file path, fingerprint, size) of the files waiting
+        self._queue = deque()
+        self._lock = Lock()
+        self._finishing = False
+        # the file being sent
+        self._file_path = None
+        self._file = None
+        # size of the file, and size sent (base64 encoded without the
+        # binary protocol), the offsets of the protocol are in this unit
+        self._file_size = None
+        self._size = None
+        self._upload_id = None
+        self._fingerprint = None
+        self._content_hash = None
+        # the job calculating the content hash of the file
+        self._workers = workers or get_worker_pool()
+        self._hash_job = None
+        self._done = False
+        self._retry_after = None
+        # the file is sent in binary frames if the server support it,
+        # if not, is base64 encoded and sent in text frames
+        self._binary = False
+        self._resumable = False
+        self._connected = False
+        self._chunk_size = MIN_CHUNK_SIZE
+        # (end offset, size, time sent) of the chunks not acknowledged
+        self._in_flight = deque()
+        self._sent = 0
+        self._acked = 0
+        self._eof = False
+        self._closed = False
+        self._srtt = None
+        self._throughput = 0
+        # the chunk size is adapted once every round trip, when the
+        # data sent until this offset is acknowledged
+        self._adapt_offset = 0
+        self._adapt_acked = 0
+        self._adapt_time = None
+        self._start_time = None
+        self._end_time = None
+        self._objects = 0
+        # size of the files finished, and of the files skipped because
+        # they don't fit in the server. The progress is in file bytes.
+        self._done_bytes = 0
+        self._skipped = 0
+        self._skipped_bytes = 0
+        self._progress_time = None
+        self._progress_acked = 0
+        self._progress_log_time = 0
+        self._rate = None
+        self._data_bytes = 0
+        self._wire_bytes = 0
+        self._round_trips = 0
+        self._window_full = False
+        self._delay = UPLOAD_RETRY_DELAY
+        self._attempt = 0
+        # the websocket of the connection, and the bytes saved by the
+        # compression in the previous connections
+        self._sock = None
+        self._compression_saved = 0
+        # round trip time measured with the pings of the last connection
+        self._link_rtt = None
+        self._ws = websocket.AsyncWebSocketApp(
+            url, loop=loop, on_open=self._on_open,
+            on_message=self._on_message, on_error=self._on_error,
+            on_close=self._on_close, compression=True,
+            ping_interval=KEEPALIVE_INTERVAL,
+            subprotocols=[RESUMABLE_UPLOAD_PROTOCOL, BINARY_UPLOAD_PROTOCOL])
+        self.add(file_path, fingerprint)
+
+    def add(self, file_path, fingerprint=None):
+        """
+        Add a file to the upload. Return False if the upload
+        already finished, then a new Uploader is needed
+        """
+        if fingerprint is None:
+            stat = os.stat(file_path)
+            fingerprint = hashlib.sha1('%s %d %f' % (
+                file_path, stat.st_size, stat.st_mtime)).hexdigest()
+        with self._lock:
+            if self._finishing:
+                return False
+            self._queue.append((file_path, fingerprint,
+                                os.path.getsize(file_path)))
+        return True
 
     def start(self):
-        upload_looop = Thread(target=self._ws.run_forever)
-        upload_looop.setDaemon(True)
-        upload_looop.start()
+        self._next_file(self._ws.start)
+
+    def _on_close(self, ws):
+        # called when every connection ends
+        self._compression_saved += self._get_compression_saved()
+        self._link_rtt = self._get_link_rtt()
+        self._sock = None
+        if self._retry_after is not None:
+            # the server is busy
+            retry_after = self._retry_after
+            self._retry_after = None
+            if self._attempt < UPLOAD_RETRIES:
+                self._ws.loop.call_later(retry_after, self._ws.start)
+                self._attempt += 1
+                return
+            logging.error('Server busy, giving up upload %s',
+                          self._upload_id)
+        if self._done:
+            # without the resumable protocol every file
+            # is sent in a new connection
+            if self._next_file(self._ws.start):
+                self._delay = UPLOAD_RETRY_DELAY
+                self._attempt = 0
+                return
+        elif not (self._connected and not self._resumable) and \
+                self._attempt < UPLOAD_RETRIES:
+            logging.error('Upload %s interrupted, retrying in %d seconds',
+                          self._upload_id, self._delay)
+            self._ws.loop.call_later(self._delay, self._ws.start)
+            self._delay *= 2
+            self._attempt += 1
+            return
+
+        if self._file is not None:
+            self._file.close()
+        GObject.idle_add(self.emit, 'uploaded')
+
+    def _next_file(self, callback):
+        """
+        Take the next file of the queue and calculate his content hash
+        in the worker pool, callback is called in the loop when done.
+        Return False if there are no more files
+        """
+        with self._lock:
+            if not self._queue:
+                self._finishing = True
+                return False
+            self._file_path, self._fingerprint, self._file_size = \
+                self._queue.popleft()
+        self._upload_id = uuid.uuid4().hex
+        self._file = None
+        self._done = False
+        self._content_hash = None
+        self._hash_job = self._workers.submit(
+            get_package_content_hash, (self._file_path,), self._hashed_cb,
+            callback, priority=PRIORITY_HIGH)
+        return True
+
+    def _hashed_cb(self, job, content_hash, callback):
+        # called in the main thread, the upload can run in other loop
+        self._ws.loop.add_callback(self._file_ready, job, content_hash,
+                                   callback)
+
+    def _file_ready(self, job, content_hash, callback):
+        if job is not self._hash_job:
+            return
+        self._hash_job = None
+        self._content_hash = content_hash
+        callback()
+
+    def _continue_file(self):
+        # the next file is sent in the same connection, if it was
+        # lost meanwhile, _on_open will start the file after reconnecting
+        if self._sock is not None:
+            self._start_file()
+
+    def get_stats(self):
+        """
+        Return a dictionary with the files and the data sent, the bytes
+        on the wire (the data, the headers of the frames and the other
+        messages), the round trips waiting for the server per MB, the
+        smoothed round trip time of the chunks and of the keepalive
+        pings (the latency of the link, without the time the chunks
+        wait in the queues), the chunk size in use and the bytes saved
+        by the compression (not subtracted from the bytes on the wire)
+        """
+        elapsed = 0
+        if self._start_time is not None:
+            elapsed = (self._end_time or time.time()) - self._start_time
+        megabytes = max(self._data_bytes, 1) / 1048576.0
+        objects = max(self._objects, 1)
+        return {'objects': self._objects,
+                'objects_per_second': self._objects / max(elapsed, 0.001),
+                'overhead_per_object':
+                    (self._wire_bytes - self._data_bytes) / objects,
+                'sent': self._data_bytes,
+                'wire_bytes': self._wire_bytes,
+                'elapsed': elapsed,
+                'round_trips': self._round_trips,
+                'round_trips_per_mb': self._round_trips / megabytes,
+                'rtt': self._srtt,
+                'link_rtt': self._get_link_rtt(),
+                'chunk_size': self._chunk_size,
+                'compression_saved':
+                    self._compression_saved + self._get_compression_saved()}
+
+    def _get_link_rtt(self):
+        if self._sock is None:
+            return self._link_rtt
+        return self._sock.rtt.srtt or self._link_rtt
+
+    def _get_compression_saved(self):
+        if self._sock is None:
+            return 0
+        stats = self._sock.get_compression_stats()
+        if stats is None:
+            return 0
+        return stats['sent_saved'] + stats['received_saved']
 
     def _on_open(self, ws):
-        if self._chunk != '':
-            self._ws.send(self._chunk)
+        self._sock = ws.sock
+        self._connected = True
+        self._resumable = ws.sock.subprotocol == RESUMABLE_UPLOAD_PROTOCOL
+        self._binary = self._resumable or \
+            ws.sock.subprotocol == BINARY_UPLOAD_PROTOCOL
+        if self._start_time is None:
+            self._start_time = time.time()
+        self._closed = False
+        self._window_full = False
+        self._srtt = None
+        self._throughput = 0
+        self._chunk_size = MIN_CHUNK_SIZE
+        if self._hash_job is None:
+            self._start_file()
+
+    def _start_file(self):
+        if self._file is None:
+            self._file = open(self._file_path, 'rb')
+            self._file_size = self._size = os.path.getsize(self._file_path)
+            if not self._binary:
+                # size of the file base64 encoded
+                self._size = (self._size + 2) / 3 * 4
+        if self._resumable:
+            self._send_message(json.dumps(
+                {'upload_id': self._upload_id,
+                 'fingerprint': self._fingerprint,
+                 'content_hash': self._content_hash,
+                 'size': self._size}))
         else:
+            self._start_from(0)
+
+    def _start_from(self, offset):
+        if self._binary:
+            self._file.seek(offset)
+        else:
+            # the offset is a multiple of 4, see _read_chunk
+            self._file.seek(offset / 4 * 3)
+        self._in_flight.clear()
+        self._eof = False
+        self._sent = self._acked = offset
+        self._adapt_offset = self._adapt_acked = offset
+        self._adapt_time = time.time()
+        self._fill_window()
+
+    def _file_done(self, uploaded=True):
+        self._done = True
+        if uploaded:
+            self._objects += 1
+            self._done_bytes += self._file_size
+        else:
+            self._skipped += 1
+            self._skipped_bytes += self._file_size
+        self._file_size = self._size = None
+        self._sent = self._acked = 0
+        self._report_progress(time.time(), force=True)
+        self._file.close()
+        self._file = None
+        if self._resumable and self._next_file(self._continue_file):
+            return
+        if not self._closed:
+            self._closed = True
+            self._end_time = time.time()
+            self._log_stats()
             self._ws.close()
 
     def _on_message(self, ws, message):
-        self._chunk = self._file.read(CHUNK_SIZE)
-        if self._chunk != '':
-            self._ws.send(self._chunk)
-        else:
+        self._wire_bytes += len(message) + _get_frame_overhead(len(message))
+        if message.startswith('OFFSET '):
+            # the data the server has of this upload
+            offset = int(message[7:])
+            if offset > 0:
+                logging.error('Resuming upload %s from %d',
+                              self._upload_id, offset)
+            self._start_from(offset)
+            return
+        elif message == 'HAVE':
+            # the server has the content, send only the metadata
+            metadata, preview_data = read_package_metadata(self._file_path)
+            self._send_message(json.dumps(
+                {'metadata': metadata,
+                 'preview': base64.b64encode(preview_data)}))
+            return
+        elif message == 'QUEUED':
+            logging.error('Upload %s queued by the server', self._upload_id)
+            return
+        elif message.startswith('RETRY '):
+            self._retry_after = int(message[6:])
+            logging.error('Server busy, retrying upload %s in %d seconds',
+                          self._upload_id, self._retry_after)
             self._ws.close()
+            return
+        elif message == 'NOSPACE':
+            logging.error('Not enough space in the server for %s',
+                          self._file_path)
+            self._file_done(uploaded=False)
+            return
+        elif message == 'DONE':
+            logging.error('Upload %s not needed, the server has the content',
+                          self._upload_id)
+            self._file_done()
+            return
+        elif message.startswith('ACK '):
+            acked = int(message[4:])
+        elif self._in_flight:
+            # old server, acknowledge the oldest chunk
+            acked = self._in_flight[0][0]
+        else:
+            return
+
+        now = time.time()
+        while self._in_flight and self._in_flight[0][0] <= acked:
+            end, size, sent_time = self._in_flight.popleft()
+            self._update_rtt(now - sent_time)
+        self._acked = max(self._acked, acked)
+
+        if self._window_full:
+            # the sender was waiting for this reply
+            self._round_trips += 1
+            self._window_full = False
+
+        if self._acked >= self._adapt_offset:
+            self._adapt_chunk_size(now)
+        self._report_progress(now)
+        self._fill_window()
+
+    def _fill_window(self):
+        while not self._eof and len(self._in_flight) < UPLOAD_WINDOW:
+            chunk = self._read_chunk()
+            if chunk == '':
+                self._eof = True
+                break
+            self._send_chunk(chunk)
+
+        if self._eof and not self._in_flight:
+            self._file_done()
+        elif len(self._in_flight) >= UPLOAD_WINDOW:
+            self._window_full = True
+
+    def _read_chunk(self):
+        if self._binary:
+            return self._file.read(self._chunk_size)
+        # encode groups of 3 bytes, then the chunks can be decoded
+        # alone, and together are the encoded file
+        return base64.b64encode(self._file.read(self._chunk_size / 4 * 3))
+
+    def _send_message(self, message):
+        self._ws.send(message)
+        self._wire_bytes += len(message) + _get_frame_overhead(len(message))
+
+    def _send_chunk(self, chunk):
+        if self._binary:
+            self._ws.send(chunk, websocket.ABNF.OPCODE_BINARY)
+        else:
+            self._ws.send(chunk)
+        self._sent += len(chunk)
+        self._data_bytes += len(chunk)
+        self._wire_bytes += len(chunk) + _get_frame_overhead(len(chunk))
+        self._in_flight.append((self._sent, len(chunk), time.time()))
+
+    def get_progress(self):
+        """
+        Return a dictionary with the bytes sent and acknowledged by the
+        server, the total to send, the throughput (bytes per second)
+        in the last PROGRESS_INTERVAL and since the start, the seconds
+        needed to finish at the current throughput (None if unknown),
+        the files finished and waiting, and the files skipped and their
+        bytes (not included in the total). The bytes are of the files,
+        before the base64 encoding used with old servers.
+        """
+        with self._lock:
+            queued_bytes = sum(size for _path, _fp, size in self._queue)
+            queued = len(self._queue)
+        total = self._done_bytes + (self._file_size or 0) + queued_bytes
+        acked = self._get_acked()
+        elapsed = 0
+        if self._start_time is not None:
+            elapsed = (self._end_time or time.time()) - self._start_time
+        average_rate = acked / elapsed if elapsed > 0 else 0
+        rate = self._rate if self._rate is not None else average_rate
+        eta = None
+        if rate > 0:
+            eta = (total - acked) / rate
+        return {'sent': self._done_bytes + self._get_file_bytes(self._sent),
+                'acked': acked,
+                'total': total,
+                'rate': rate,
+                'average_rate': average_rate,
+                'eta': eta,
+                'objects': self._objects,
+                'queued': queued,
+                'skipped': self._skipped,
+                'skipped_bytes': self._skipped_bytes}
+
+    def _get_acked(self):
+        return self._done_bytes + self._get_file_bytes(self._acked)
+
+    def _get_file_bytes(self, offset):
+        # bytes of the file at an offset of the upload
+        if self._file_size is None:
+            return 0
+        if not self._binary:
+            offset = offset / 4 * 3
+        return min(offset, self._file_size)
+
+    def _report_progress(self, now, force=False):
+        # called for every acknowledge, then only compares times
+        # until PROGRESS_INTERVAL passed
+        if self._progress_time is None:
+            self._progress_time = now
+            self._progress_acked = self._get_acked()
+            return
+        elapsed = now - self._progress_time
+        if elapsed >= PROGRESS_INTERVAL:
+            acked = self._get_acked()
+            rate = (acked - self._progress_acked) / elapsed
+            if self._rate is None:
+                self._rate = rate
+            else:
+                self._rate = 0.5 * self._rate + 0.5 * rate
+            self._progress_time = now
+            self._progress_acked = acked
+        elif not force:
+            return
+
+        progress = self.get_progress()
+        GObject.idle_add(self.emit, 'progress', progress)
+        if now - self._progress_log_time >= PROGRESS_LOG_INTERVAL:
+            self._progress_log_time = now
+            logging.error('Upload progress %d of %d bytes, %.1f KB/s, '
+                          'average %.1f KB/s, rtt %.3f s, eta %s s',
+                          progress['acked'], progress['total'],
+                          progress['rate'] / 1024.0,
+                          progress['average_rate'] / 1024.0,
+                          self._srtt or 0, progress['eta'])
+
+    def _update_rtt(self, rtt):
+        if self._srtt is None:
+            self._srtt = rtt
+        else:
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+
+    def _adapt_chunk_size(self, now):
+        """
+        Called once every round trip. The chunk size is doubled while
+        that increases the throughput, and halved when the throughput
+        drops or the round trip time is so long that other messages
+        sent to the server would wait too much
+        """
+        elapsed = now - self._adapt_time
+        if elapsed > 0 and self._srtt is not None:
+            throughput = (self._acked - self._adapt_acked) / elapsed
+            if self._srtt > MAX_UPLOAD_RTT or \
+                    throughput < 0.8 * self._throughput:
+                self._chunk_size = max(MIN_CHUNK_SIZE, self._chunk_size / 2)
+            elif throughput > 1.1 * self._throughput:
+                self._chunk_size = min(MAX_CHUNK_SIZE, self._chunk_size * 2)
+            self._throughput = throughput
+        self._adapt_acked = self._acked
+        self._adapt_offset = self._sent
+        self._adapt_time = now
+
+    def _log_stats(self):
+        stats = self.get_stats()
+        logging.error('Uploaded %d objects, %d bytes, %d on the wire, in '
+                      '%.2f s, %.1f KB/s, %.1f objects/s, %d bytes of '
+                      'overhead per object, %.1f round trips per MB, '
+                      'rtt %.3f s, chunk size %d, %d bytes saved by '
+                      'compression',
+                      stats['objects'], stats['sent'], stats['wire_bytes'],
+                      stats['elapsed'],
+                      stats['sent'] / 1024.0 / max(stats['elapsed'], 0.001),
+                      stats['objects_per_second'],
+                      stats['overhead_per_object'],
+                      stats['round_trips_per_mb'], stats['rtt'] or 0,
+                      stats['chunk_size'], stats['compression_saved'])
 
     def _on_error(self, ws, error):
-        #self._ws.send(self._chunk)
-        pass
+        logging.error('Upload error %s', error)
+
+
+def _get_frame_overhead(length):
+    """
+    Return the size of the header of a masked websocket frame
+    with a payload of length bytes
+    """
+    if length < 126:
+        return 6
+    elif length < 65536:
+        return 8
+    return 14
+
+
+class ControlChannel(object):
+    """
+    Connection to the /websocket of a server, shared by all the
+    Messangers with the same url, see get_control_channel.
+
+    The messages are queued, and the ones queued within
+    CONTROL_BATCH_DELAY are sent together in a 'BATCH' message. The
+    channel connects when there are messages to send, in the GLib main
+    loop or in the loop given (see websocket.AsyncWebSocketApp). If the
+    connection is lost, the channel reconnects and sends again the
+    messages not written.
+
+    The socket is read all the time the connection is open, the pings
+    and the close of the server are answered, and the replies to the
+    messages are discarded, then they don't fill the socket buffers.
+    """
+
+    def __init__(self, url, loop=None):
+        self._url = url
+        self._loop = loop or websocket.GLibEventLoop()
+        # (message data, callback) tuples waiting to be sent
+        self._pending = []
+        # the ones sent in frames not written yet
+        self._sending = []
+        self._ws = None
+        self._open = False
+        self._flush_timeout = None
+        self._retry_timeout = None
+        self._delay = CONTROL_RETRY_DELAY
+        self._messages = 0
+        self._frames = 0
+
+    def send_message(self, type_message, message, callback=None):
+        """
+        Queue a message, callback is called in the main thread
+        with type_message when the message is sent
+        """
+        self._pending.append(({'type_message': type_message,
+                               'message': message}, callback))
+        if self._flush_timeout is None and self._retry_timeout is None:
+            self._flush_timeout = self._loop.call_later(CONTROL_BATCH_DELAY,
+                                                        self._flush)
+
+    def get_stats(self):
+        """
+        Return a dictionary with the messages sent, the frames used to
+        send them, and the messages waiting to be sent
+        """
+        return {'messages': self._messages,
+                'frames': self._frames,
+                'queued': len(self._pending) + len(self._sending)}
+
+    def _flush(self):
+        self._flush_timeout = None
+        if self._ws is None:
+            self._connect()
+        elif self._open:
+            while self._pending:
+                batch = self._pending[:CONTROL_BATCH_SIZE]
+                del self._pending[:len(batch)]
+                self._sending.extend(batch)
+                self._ws.send(self._format(batch),
+                              callback=functools.partial(self._sent_cb,
+                                                         batch))
+
+    def _connect(self):
+        self._retry_timeout = None
+        self._ws = websocket.AsyncWebSocketApp(
+            self._url, loop=self._loop, on_open=self._on_open,
+            on_message=self._on_message, on_error=self._on_error,
+            on_close=self._on_close, compression=True,
+            ping_interval=KEEPALIVE_INTERVAL)
+        self._ws.start()
+
+    def _on_open(self, ws):
+        self._open = True
+        self._delay = CONTROL_RETRY_DELAY
+        self._flush()
+
+    def _on_message(self, ws, message):
+        # the server echoes the messages it doesn't know
+        logging.debug('Discarding reply from %s: %s', self._url,
+                      message[:80])
+
+    def _sent_cb(self, batch):
+        del self._sending[:len(batch)]
+        self._messages += len(batch)
+        self._frames += 1
+        for message_data, callback in batch:
+            if callback is not None:
+                GObject.idle_add(callback, message_data['type_message'])
+        logging.debug('Control channel to %s: %s', self._url,
+                      self.get_stats())
+
+    def _on_error(self, ws, error):
+        logging.error('Error in the connection to %s: %s', self._url, error)
 
     def _on_close(self, ws):
-        self._file.close()
-        GObject.idle_add(self.emit, 'uploaded')
+        self._ws = None
+        self._open = False
+        self._pending[0:0] = self._sending
+        self._sending = []
+        if self._pending:
+            logging.error('Lost the connection to %s, '
+                          'retrying in %d seconds', self._url, self._delay)
+            if self._flush_timeout is not None:
+                self._loop.remove_timeout(self._flush_timeout)
+                self._flush_timeout = None
+            self._retry_timeout = self._loop.call_later(self._delay,
+                                                        self._connect)
+            self._delay = min(self._delay * 2, CONTROL_MAX_RETRY_DELAY)
+
+    def _format(self, batch):
+        if len(batch) == 1:
+            return json.dumps(batch[0][0])
+        return json.dumps({'type_message': 'BATCH',
+                           'message': [message_data for message_data, callback
+                                       in batch]})
+
+
+_control_channels = {}
+_control_channels_lock = Lock()
+
+
+def get_control_channel(url):
+    """
+    Return the ControlChannel to url, creating it the first time
+    """
+    with _control_channels_lock:
+        if url not in _control_channels:
+            _control_channels[url] = ControlChannel(url)
+        return _control_channels[url]
 
 
 class Messanger(GObject.GObject):
@@ -85,26 +771,103 @@ class Messanger(GObject.GObject):
     def __init__(self, url):
         GObject.GObject.__init__(self)
         logging.error('websocket url %s', url)
-        self._ws = websocket.WebSocketApp(url,
-                                          on_open=self._on_open,
-                                          on_message=self._on_message,
-                                          on_error=self._on_error)
+        self._channel = get_control_channel(url)
 
     def send_message(self, type_message, message):
-        self._message_data = {'type_message': type_message, 'message': message}
-        message_looop = Thread(target=self._ws.run_forever)
-        message_looop.setDaemon(True)
-        message_looop.start()
+        self._channel.send_message(type_message, message, self._sent_cb)
 
-    def _on_open(self, ws):
-        self._ws.send(json.dumps(self._message_data))
+    def _sent_cb(self, type_message):
+        self.emit('sent', type_message)
 
-    def _on_message(self, ws, message):
-        message_data = json.loads(message)
-        GObject.idle_add(self.emit, 'sent', message_data)
 
-    def _on_error(self, ws, error):
-        pass
+class WorkerJob(object):
+    """
+    A function queued in a WorkerPool
+    """
+
+    def __init__(self, function, args, callback, user_data):
+        self._function = function
+        self._args = args
+        self._callback = callback
+        self._user_data = user_data
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        The job will not run if was not started yet,
+        the callback is called anyway
+        """
+        self.cancelled = True
+
+    def run(self):
+        result = None
+        if not self.cancelled:
+            try:
+                result = self._function(*self._args)
+            except:
+                logging.exception('Error running job %s', self._function)
+        GObject.idle_add(self._done_cb, result)
+
+    def _done_cb(self, result):
+        self._callback(self, result, *self._user_data)
+        return False
+
+
+class WorkerPool(object):
+    """
+    A bounded pool of threads, by default one for every available core,
+    used to run the slow file operations out of the main thread.
+    The jobs with a lower priority value run first, and the callbacks
+    are called in the main thread as callback(job, result, *user_data)
+    """
+
+    def __init__(self, size=None):
+        if size is None:
+            try:
+                size = multiprocessing.cpu_count()
+            except NotImplementedError:
+                size = 1
+        self._queue = Queue.PriorityQueue()
+        self._counter = itertools.count()
+        for i in range(size):
+            worker = Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+
+    def submit(self, function, args, callback, *user_data, **kwargs):
+        priority = kwargs.get('priority', PRIORITY_LOW)
+        job = WorkerJob(function, args, callback, user_data)
+        self._queue.put((priority, self._counter.next(), job))
+        return job
+
+    def _work(self):
+        while True:
+            _priority, _count, job = self._queue.get()
+            job.run()
+
+
+_worker_pool = None
+_worker_pool_lock = Lock()
+
+
+def get_worker_pool():
+    """
+    Return the WorkerPool shared by the objects not having their own,
+    creating it the first time
+    """
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = WorkerPool()
+        return _worker_pool
+
+
+def get_free_space(path='/'):
+    """
+    Return the free space, in bytes, in the device of path
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
 
 
 def get_user_data():
@@ -122,6 +885,43 @@ def get_user_data():
     return data
 
 
+def save_preview(dsobj, destination_path):
+    """
+    Save the preview of a journal object in a file, and return the path,
+    or None if the object has no preview
+    """
+    if 'preview' not in dsobj.metadata:
+        return None
+
+    # TODO: copied from expandedentry.py
+    # is needed because record is saving the preview encoded
+    if dsobj.metadata['preview'][1:4] == 'PNG':
+        preview = dsobj.metadata['preview']
+    else:
+        # TODO: We are close to be able to drop this.
+        preview = base64.b64decode(dsobj.metadata['preview'])
+
+    preview_path = os.path.join(destination_path,
+                                'preview_id_' + dsobj.object_id)
+    preview_file = open(preview_path, 'w')
+    preview_file.write(preview)
+    preview_file.close()
+    return preview_path
+
+
+class ObjectData(object):
+    """
+    The id, the metadata and the file path of a journal object, read
+    from the datastore in the main thread, to package the object in
+    the worker threads without D-Bus calls
+    """
+
+    def __init__(self, object_id, metadata, file_path=None):
+        self.object_id = object_id
+        self.metadata = dict((key, metadata[key]) for key in metadata.keys())
+        self.file_path = file_path
+
+
 def package_ds_object(dsobj, destination_path):
     """
     Creates a zipped file with the file associated to a journal object,
@@ -129,23 +929,9 @@ def package_ds_object(dsobj, destination_path):
     """
     object_id = dsobj.object_id
     logging.error('id %s', object_id)
-    preview_path = None
 
     logging.error('before preview')
-    if 'preview' in dsobj.metadata:
-        # TODO: copied from expandedentry.py
-        # is needed because record is saving the preview encoded
-        if dsobj.metadata['preview'][1:4] == 'PNG':
-            preview = dsobj.metadata['preview']
-        else:
-            # TODO: We are close to be able to drop this.
-            preview = base64.b64decode(dsobj.metadata['preview'])
-
-        preview_path = os.path.join(destination_path,
-                                    'preview_id_' + object_id)
-        preview_file = open(preview_path, 'w')
-        preview_file.write(preview)
-        preview_file.close()
+    preview_path = save_preview(dsobj, destination_path)
 
     logging.error('before metadata')
     # create file with the metadata
@@ -175,15 +961,70 @@ def package_ds_object(dsobj, destination_path):
     return file_path
 
 
-def unpackage_ds_object(origin_path):
+def unpackage_ds_object(origin_path, destination_path=None):
     """
     Receive a path of a zipped file, unzip it, and save the data,
-    preview and metadata on a journal object
+    preview and metadata on a journal object.
+    The data is extracted in destination_path, by default
+    the directory of the zipped file.
     """
-    tmp_path = os.path.dirname(origin_path)
+    if destination_path is None:
+        destination_path = os.path.dirname(origin_path)
+    metadata, preview_data = read_package_metadata(origin_path)
     with ZipFile(origin_path) as zipped:
+        zipped.extract('data', destination_path)
+
+    return metadata, preview_data, os.path.join(destination_path, 'data')
+
+
+def read_package_metadata(package_path):
+    """
+    Return the metadata and the preview saved in a zipped file
+    created by package_ds_object, without extracting the data
+    """
+    with ZipFile(package_path) as zipped:
         metadata = json.loads(zipped.read('metadata'))
-        preview_data = zipped.read('preview')
-        zipped.extract('data', tmp_path)
+        if 'preview' in zipped.namelist():
+            preview_data = zipped.read('preview')
+        else:
+            preview_data = ''
+    return metadata, preview_data
+
 
-    return metadata, preview_data, os.path.join(tmp_path, 'data')
+def get_content_hash(data_file):
+    """
+    Return the sha1 of the content of a file object, used to know
+    if two journal objects have the same data
+    """
+    hasher = hashlib.sha1()
+    while True:
+        chunk = data_file.read(65536)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_package_content_hash(package_path):
+    """
+    Return the content hash of the data in a zipped file
+    created by package_ds_object
+    """
+    with ZipFile(package_path) as zipped:
+        data_file = zipped.open('data')
+        try:
+            return get_content_hash(data_file)
+        finally:
+            data_file.close()
+
+
+def remove_packaged_files(object_id, destination_path):
+    """
+    Remove the files created by package_ds_object for a journal object
+    """
+    for file_name in ('preview_id_' + object_id,
+                      'metadata_id_' + object_id,
+                      'id_' + object_id + '.journal'):
+        file_path = os.path.join(destination_path, file_name)
+        if os.path.isfile(file_path):
+            os.remove(file_path)
@@ -23,12 +23,22 @@ Copyright (C) 2010 Hiroki Ohtani(liris)
 import socket
 from urlparse import urlparse
 import os
+import errno
+import time
+import functools
 import struct
 import uuid
 import sha
 import base64
 import logging
 
+from collections import deque
+
+from tornado.util import websocket_mask
+from tornado.util import parse_websocket_extensions
+from tornado.util import PerMessageCompressor, PerMessageDecompressor
+from tornado.util import RttEstimator, get_ping_timeout
+
 """
 websocket python client.
 =========================
@@ -181,9 +191,132 @@ class _SSLSocketWrapper(object):
     def recv(self, bufsize):
         return self.ssl.read(bufsize)
     
+    def recv_into(self, buffer):
+        data = self.ssl.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
     def send(self, payload):
         return self.ssl.write(payload)
 
+# size of the buffer used to read from the socket
+RECV_BUFFER_SIZE = 65536
+
+class _SocketBuffer(object):
+    """
+    Buffered reader of a socket.
+
+    The data is received with recv_into in a bytearray reused between
+    reads, so a frame header, or the lines of the handshake, are read
+    from the buffer with a few recv calls. Payloads bigger than the
+    buffer are received directly in a bytearray of his size.
+    """
+    def __init__(self, sock, size=RECV_BUFFER_SIZE):
+        self.sock = sock
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    def pending(self):
+        """
+        Number of bytes in the buffer not read yet.
+        """
+        return self._end - self._start
+
+    def peek(self, bufsize):
+        """
+        Return up to bufsize bytes without reading them.
+        """
+        return self._view[self._start:self._start + bufsize].tobytes()
+
+    def find(self, sub):
+        """
+        Return the position of sub in the bytes not read, or -1.
+        """
+        index = self._buffer.find(sub, self._start, self._end)
+        if index == -1:
+            return -1
+        return index - self._start
+
+    def fill(self, size=0):
+        """
+        Receive data once, with room in the buffer for size bytes.
+        Used by AsyncWebSocketApp when the socket is readable.
+        """
+        length = self._end - self._start
+        if size > len(self._buffer) or \
+                (length == 0 and len(self._buffer) > RECV_BUFFER_SIZE and
+                 size <= RECV_BUFFER_SIZE):
+            # grow the buffer for a big frame,
+            # and go back to the usual size after it
+            buffer = bytearray(max(size, RECV_BUFFER_SIZE))
+            buffer[:length] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+            self._start, self._end = 0, length
+        return self._fill()
+
+    def _fill(self):
+        # receive more data at the end of the buffer,
+        # moving the bytes not read to the beginning if it is full
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buffer):
+            length = self._end - self._start
+            self._buffer[:length] = self._view[self._start:self._end]
+            self._start, self._end = 0, length
+        received = self.sock.recv_into(self._view[self._end:])
+        if not received:
+            raise WebSocketException("Connection is already closed.")
+        self._end += received
+        return received
+
+    def read(self, bufsize):
+        """
+        Read exactly bufsize bytes.
+        """
+        if self._end - self._start < bufsize and \
+                bufsize > len(self._buffer) / 2:
+            return self._read_large(bufsize)
+        while self._end - self._start < bufsize:
+            self._fill()
+        start = self._start
+        self._start += bufsize
+        return self._view[start:self._start].tobytes()
+
+    def _read_large(self, bufsize):
+        data = bytearray(bufsize)
+        view = memoryview(data)
+        length = self._end - self._start
+        view[:length] = self._view[self._start:self._end]
+        self._start = self._end = 0
+        while length < bufsize:
+            received = self.sock.recv_into(view[length:])
+            if not received:
+                raise WebSocketException("Connection is already closed.")
+            length += received
+        return str(data)
+
+    def readline(self):
+        """
+        Read up to and including the next newline.
+        """
+        searched = self._start
+        while True:
+            index = self._buffer.find("\n", searched, self._end)
+            if index != -1:
+                break
+            if self._start == 0 and self._end == len(self._buffer):
+                raise WebSocketException("Header line too long")
+            searched = self._end - self._start
+            self._fill()
+            searched += self._start
+        start = self._start
+        self._start = index + 1
+        return self._view[start:self._start].tobytes()
+
+
 _BOOL_VALUES = (0, 1)
 def _is_bool(*values):
     for v in values:
@@ -192,6 +325,30 @@ def _is_bool(*values):
     
     return True
 
+def _get_frame_length(header):
+    """
+    Return the length of a frame, including the header, from his first
+    bytes, or None if more bytes are needed to know it.
+    """
+    if len(header) < 2:
+        return None
+    b2 = ord(header[1])
+    length = b2 & 0x7f
+    size = 2
+    if b2 >> 7 & 1:
+        size += 4
+    if length == 0x7e:
+        if len(header) < 4:
+            return None
+        length = struct.unpack("!H", header[2:4])[0]
+        size += 2
+    elif length == 0x7f:
+        if len(header) < 10:
+            return None
+        length = struct.unpack("!Q", header[2:10])[0]
+        size += 8
+    return size + length
+
 class ABNF(object):
     """
     ABNF frame class.
@@ -292,18 +449,14 @@ class ABNF(object):
     @staticmethod
     def mask(mask_key, data):
         """
-        mask or unmask data. Just do xor for each byte
+        mask or unmask data. Just do xor for each byte,
+        see tornado.util.websocket_mask
 
         mask_key: 4 byte string(byte).
         
         data: data to mask/unmask.
         """
-        _m = map(ord, mask_key)
-        _d = map(ord, data)
-        for i in range(len(_d)):
-            _d[i] ^= _m[i % 4]
-        s = map(chr, _d)
-        return "".join(s)
+        return websocket_mask(mask_key, data)
 
 class WebSocket(object):
     """
@@ -332,7 +485,20 @@ class WebSocket(object):
         """
         self.connected = False
         self.io_sock = self.sock = socket.socket()
+        self._buffer = _SocketBuffer(self.io_sock)
         self.get_mask_key = get_mask_key
+        self.subprotocol = None
+        # permessage-deflate compression, if the server accepts it
+        self._compression_offered = False
+        self._compressor = None
+        self._decompressor = None
+        self._sent_saved = 0
+        self._received_saved = 0
+        # round trip times measured with the pings, the payload and
+        # the time of the ping waiting for the pong
+        self.rtt = RttEstimator()
+        self._ping_payload = None
+        self._ping_time = None
         
     def set_mask_key(self, func):
         """
@@ -374,9 +540,14 @@ class WebSocket(object):
                  if you set None for this value,
                  it means "use default_timeout value"
 
-        options: current support option is only "header".
+        options: "header", "subprotocols" and "compression" are supported.
                  if you set header as dict value,
                  the custom HTTP headers are added.
+                 subprotocols is a list of the subprotocols requested,
+                 the one selected by the server is saved in the
+                 subprotocol attribute.
+                 if compression is True, the permessage-deflate
+                 extension is requested.
 
         """
         hostname, port, resource, is_secure = _parse_url(url)
@@ -384,10 +555,22 @@ class WebSocket(object):
         self.sock.connect((hostname, port))
         if is_secure:
             self.io_sock = _SSLSocketWrapper(self.sock)
+            self._buffer = _SocketBuffer(self.io_sock)
         self._handshake(hostname, port, resource, **options)
 
     def _handshake(self, host, port, resource, **options):
-        sock = self.io_sock
+        header_str, key = self._get_handshake_request(host, port, resource,
+                                                      **options)
+        self.io_sock.send(header_str)
+        if traceEnabled:
+            logger.debug( "--- request header ---")
+            logger.debug( header_str)
+            logger.debug("-----------------------")
+
+        status, resp_headers = self._read_headers()
+        self._check_handshake(status, resp_headers, key)
+
+    def _get_handshake_request(self, host, port, resource, **options):
         headers = []
         headers.append("GET %s HTTP/1.1" % resource)
         headers.append("Upgrade: websocket")
@@ -401,22 +584,24 @@ class WebSocket(object):
    
         key = _create_sec_websocket_key()
         headers.append("Sec-WebSocket-Key: %s" % key)
-        headers.append("Sec-WebSocket-Protocol: chat, superchat")
+        if options.get("subprotocols"):
+            headers.append("Sec-WebSocket-Protocol: %s" %
+                           ", ".join(options["subprotocols"]))
+        else:
+            headers.append("Sec-WebSocket-Protocol: chat, superchat")
         headers.append("Sec-WebSocket-Version: %s" % VERSION)
+        self._compression_offered = bool(options.get("compression"))
+        if self._compression_offered:
+            headers.append("Sec-WebSocket-Extensions: permessage-deflate")
         if "header" in options:
             headers.extend(options["header"])
 
         headers.append("")
         headers.append("")
 
-        header_str = "\r\n".join(headers)
-        sock.send(header_str)
-        if traceEnabled:
-            logger.debug( "--- request header ---")
-            logger.debug( header_str)
-            logger.debug("-----------------------")
+        return "\r\n".join(headers), key
 
-        status, resp_headers = self._read_headers()
+    def _check_handshake(self, status, resp_headers, key):
         if status != 101:
             self.close()
             raise WebSocketException("Handshake Status %d" % status)
@@ -426,6 +611,18 @@ class WebSocket(object):
             self.close()
             raise WebSocketException("Invalid WebSocket Header")
 
+        self.subprotocol = resp_headers.get("sec-websocket-protocol", None)
+        extensions = parse_websocket_extensions(
+            resp_headers.get("sec-websocket-extensions", ""))
+        for name, params in extensions:
+            if name != "permessage-deflate" or not self._compression_offered:
+                self.close()
+                raise WebSocketException("Unexpected extension %s" % name)
+            self._compressor = PerMessageCompressor(
+                persistent="client_no_context_takeover" not in params,
+                max_wbits=int(params.get("client_max_window_bits") or 15))
+            self._decompressor = PerMessageDecompressor(
+                persistent="server_no_context_takeover" not in params)
         self.connected = True
     
     def _validate_header(self, headers, key):
@@ -485,10 +682,7 @@ class WebSocket(object):
 
         opcode: operation code to send. Please see OPCODE_XXX.
         """
-        frame = ABNF.create_frame(payload, opcode)
-        if self.get_mask_key:
-            frame.get_mask_key = self.get_mask_key
-        data = frame.format()
+        data = self._format_frame(payload, opcode)
         self.io_sock.send(data)
         if traceEnabled:
             logger.debug("send: " + repr(data))
@@ -509,6 +703,48 @@ class WebSocket(object):
         """
         self.send(payload, ABNF.OPCODE_PONG)
 
+    def _start_ping(self):
+        # return the payload of a ping measuring the round trip time
+        self._ping_time = time.time()
+        self._ping_payload = struct.pack("!d", self._ping_time)
+        return self._ping_payload
+
+    def _on_pong(self, payload):
+        if self._ping_payload is not None and payload == self._ping_payload:
+            self.rtt.update(time.time() - self._ping_time)
+            self._ping_payload = None
+            self._ping_time = None
+
+    def get_rtt_stats(self):
+        """
+        Return a dictionary with the round trip times measured with the
+        pings, see tornado.util.RttEstimator.get_stats.
+        """
+        return self.rtt.get_stats()
+
+    def _format_frame(self, payload, opcode):
+        frame = ABNF.create_frame(payload, opcode)
+        if self._compressor is not None and \
+                opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+            compressed = self._compressor.compress(frame.data)
+            if compressed is not None:
+                self._sent_saved += len(frame.data) - len(compressed)
+                frame.data = compressed
+                frame.rsv1 = 1
+        if self.get_mask_key:
+            frame.get_mask_key = self.get_mask_key
+        return frame.format()
+
+    def get_compression_stats(self):
+        """
+        Return a dictionary with the bytes saved by the compression in
+        the messages sent and received, None if not compressed.
+        """
+        if self._compressor is None:
+            return None
+        return {"sent_saved": self._sent_saved,
+                "received_saved": self._received_saved}
+
     def recv(self):
         """
         Receive string data(byte array) from the server.
@@ -518,9 +754,12 @@ class WebSocket(object):
         opcode, data = self.recv_data()
         return data
 
-    def recv_data(self):
+    def recv_data(self, control_frame = False):
         """
         Recieve data with operation code.
+
+        control_frame: return the pings and pongs received too,
+          they are answered and measured anyway.
         
         return  value: tuple of operation code and string(byte array) value.
         """
@@ -536,8 +775,37 @@ class WebSocket(object):
                 self.send_close()
                 return (frame.opcode, None)
             elif frame.opcode == ABNF.OPCODE_PING:
-                self.pong("Hi!")
+                self.pong(frame.data)
+                if control_frame:
+                    return (frame.opcode, frame.data)
+            elif frame.opcode == ABNF.OPCODE_PONG:
+                self._on_pong(frame.data)
+                if control_frame:
+                    return (frame.opcode, frame.data)
+
 
+    def _wait_frame(self, timeout):
+        """
+        Wait up to timeout seconds for a whole frame, then recv_frame
+        doesn't block. Return False if the time passed.
+        """
+        deadline = time.time() + timeout
+        previous_timeout = self.sock.gettimeout()
+        try:
+            while True:
+                length = _get_frame_length(self._buffer.peek(14))
+                if length is not None and self._buffer.pending() >= length:
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.sock.settimeout(remaining)
+                try:
+                    self._buffer.fill(length or 14)
+                except socket.timeout:
+                    return False
+        finally:
+            self.sock.settimeout(previous_timeout)
 
     def recv_frame(self):
         """
@@ -545,8 +813,10 @@ class WebSocket(object):
 
         return value: ABNF frame object.
         """
-        header_bytes = self._recv(2)
-        if not header_bytes:
+        try:
+            header_bytes = self._recv(2)
+        except WebSocketException:
+            # the connection was closed between frames
             return None
         b1 = ord(header_bytes[0])
         fin = b1 >> 7 & 1
@@ -576,6 +846,12 @@ class WebSocket(object):
 
         if mask:
             data = ABNF.mask(mask_key, data)
+
+        if rsv1 and self._decompressor is not None and \
+                opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+            compressed_length = len(data)
+            data = self._decompressor.decompress(data)
+            self._received_saved += len(data) - compressed_length
         
         frame = ABNF(fin, rsv1, rsv2, rsv3, opcode, mask, data)
         return frame
@@ -626,29 +902,17 @@ class WebSocket(object):
         self.connected = False
         self.sock.close()
         self.io_sock = self.sock
-        
+        self._buffer = _SocketBuffer(self.io_sock)
+
     def _recv(self, bufsize):
-        bytes = self.io_sock.recv(bufsize)
-        return bytes
+        return self._buffer.read(bufsize)
 
     def _recv_strict(self, bufsize):
-        remaining = bufsize
-        bytes = ""
-        while remaining:
-            bytes += self._recv(remaining)
-            remaining = bufsize - len(bytes)
-            
-        return bytes
+        return self._buffer.read(bufsize)
 
     def _recv_line(self):
-        line = []
-        while True:
-            c = self._recv(1)
-            line.append(c)
-            if c == "\n":
-                break
-        return "".join(line)
-            
+        return self._buffer.readline()
+
 class WebSocketApp(object):
     """
     Higher level of APIs are provided. 
@@ -656,7 +920,9 @@ class WebSocketApp(object):
     """
     def __init__(self, url,
                  on_open = None, on_message = None, on_error = None, 
-                 on_close = None, keep_running = True, get_mask_key = None):
+                 on_close = None, keep_running = True, get_mask_key = None,
+                 subprotocols = None, compression = False,
+                 ping_interval = None, ping_timeout = None):
         """
         url: websocket url.
         on_open: callable object which is called at opening websocket.
@@ -675,6 +941,15 @@ class WebSocketApp(object):
          keep running, defaults to True
        get_mask_key: a callable to produce new mask keys, see the WebSocket.set_mask_key's
          docstring for more information
+       subprotocols: list of subprotocols requested to the server, the
+         selected one is available in sock.subprotocol
+       compression: request the permessage-deflate extension, see
+         sock.get_compression_stats
+       ping_interval: seconds between the keepalive pings sent to the
+         server, None to not send them. The round trip times are
+         available in sock.get_rtt_stats
+       ping_timeout: seconds to wait for a pong before closing the
+         connection, by default three intervals, at least 30 seconds
         """
         self.url = url
         self.on_open = on_open
@@ -683,13 +958,18 @@ class WebSocketApp(object):
         self.on_close = on_close
         self.keep_running = keep_running
         self.get_mask_key = get_mask_key
+        self.subprotocols = subprotocols
+        self.compression = compression
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
         self.sock = None
 
-    def send(self, data):
+    def send(self, data, opcode = ABNF.OPCODE_TEXT):
         """
-        send message. data must be utf-8 string or unicode.
+        send message. data must be utf-8 string or unicode,
+        or a byte string if opcode is OPCODE_BINARY.
         """
-        self.sock.send(data)
+        self.sock.send(data, opcode)
 
     def close(self):
         """
@@ -707,13 +987,22 @@ class WebSocketApp(object):
             raise WebSocketException("socket is already opened")
         try:
             self.sock = WebSocket(self.get_mask_key)
-            self.sock.connect(self.url)
+            self.sock.connect(self.url, subprotocols=self.subprotocols,
+                              compression=self.compression)
             self._run_with_no_err(self.on_open)
+            next_ping = None
+            if self.ping_interval:
+                next_ping = time.time() + self.ping_interval
             while self.keep_running:
-                data = self.sock.recv()
-                if data is None:
+                if next_ping is not None and \
+                        not self.sock._wait_frame(next_ping - time.time()):
+                    next_ping = time.time() + self._keepalive()
+                    continue
+                opcode, data = self.sock.recv_data(control_frame=True)
+                if opcode == ABNF.OPCODE_CLOSE:
                     break
-                self._run_with_no_err(self.on_message, data)
+                if opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+                    self._run_with_no_err(self.on_message, data)
         except Exception, e:
             self._run_with_no_err(self.on_error, e)
         finally:
@@ -721,6 +1010,17 @@ class WebSocketApp(object):
             self._run_with_no_err(self.on_close)
             self.sock = None
 
+    def _keepalive(self):
+        # send a ping if the previous one was answered, return the
+        # seconds until the next ping or until the pong is late
+        timeout = get_ping_timeout(self.ping_interval, self.ping_timeout)
+        now = time.time()
+        if self.sock._ping_time is None:
+            self.send(self.sock._start_ping(), ABNF.OPCODE_PING)
+        elif now - self.sock._ping_time >= timeout:
+            raise WebSocketException("No pong received, closing")
+        return min(self.ping_interval, self.sock._ping_time + timeout - now)
+
     def _run_with_no_err(self, callback, *args):
         if callback:
             try:
@@ -730,6 +1030,345 @@ class WebSocketApp(object):
                     logger.error(e)
 
 
+class GLibEventLoop(object):
+    """
+    Run AsyncWebSocketApps in the GLib main loop.
+    """
+    def __init__(self):
+        from gi.repository import GLib
+        self._glib = GLib
+
+    def watch_read(self, fd, callback):
+        return self._glib.io_add_watch(
+            fd, self._glib.PRIORITY_DEFAULT,
+            self._glib.IO_IN | self._glib.IO_HUP | self._glib.IO_ERR,
+            self._watch_cb, callback)
+
+    def watch_write(self, fd, callback):
+        return self._glib.io_add_watch(
+            fd, self._glib.PRIORITY_DEFAULT,
+            self._glib.IO_OUT | self._glib.IO_ERR,
+            self._watch_cb, callback)
+
+    def remove_watch(self, handle):
+        self._glib.source_remove(handle)
+
+    def call_later(self, seconds, callback, *args):
+        return self._glib.timeout_add(int(seconds * 1000), self._call_once,
+                                      callback, args)
+
+    def remove_timeout(self, handle):
+        self._glib.source_remove(handle)
+
+    def add_callback(self, callback, *args):
+        self._glib.idle_add(self._call_once, callback, args)
+
+    def _watch_cb(self, source, condition, callback):
+        callback()
+        return True
+
+    def _call_once(self, callback, args):
+        callback(*args)
+        return False
+
+
+class TornadoEventLoop(object):
+    """
+    Run AsyncWebSocketApps in a tornado IOLoop, by default the
+    global instance. Must be used from the thread of the IOLoop.
+    """
+    def __init__(self, io_loop=None):
+        from tornado import ioloop
+        self._io_loop = io_loop or ioloop.IOLoop.instance()
+        self._read = ioloop.IOLoop.READ
+        self._write = ioloop.IOLoop.WRITE
+        self._error = ioloop.IOLoop.ERROR
+        # fd -> {events: callback}
+        self._handlers = {}
+
+    def watch_read(self, fd, callback):
+        return self._watch(fd, self._read, callback)
+
+    def watch_write(self, fd, callback):
+        return self._watch(fd, self._write, callback)
+
+    def remove_watch(self, handle):
+        fd, events = handle
+        handlers = self._handlers.get(fd)
+        if not handlers or events not in handlers:
+            return
+        del handlers[events]
+        if handlers:
+            self._io_loop.update_handler(fd, sum(handlers))
+        else:
+            del self._handlers[fd]
+            self._io_loop.remove_handler(fd)
+
+    def call_later(self, seconds, callback, *args):
+        return self._io_loop.add_timeout(time.time() + seconds,
+                                         functools.partial(callback, *args))
+
+    def remove_timeout(self, handle):
+        self._io_loop.remove_timeout(handle)
+
+    def add_callback(self, callback, *args):
+        self._io_loop.add_callback(functools.partial(callback, *args))
+
+    def _watch(self, fd, events, callback):
+        handlers = self._handlers.get(fd)
+        if handlers is None:
+            self._handlers[fd] = {events: callback}
+            self._io_loop.add_handler(fd, self._handle_events, events)
+        else:
+            handlers[events] = callback
+            self._io_loop.update_handler(fd, sum(handlers))
+        return fd, events
+
+    def _handle_events(self, fd, events):
+        # the callbacks can remove the watches
+        for watched, ready in ((self._read, self._read | self._error),
+                               (self._write, self._write | self._error)):
+            callback = self._handlers.get(fd, {}).get(watched)
+            if callback is not None and events & ready:
+                callback()
+
+
+class AsyncWebSocketApp(WebSocketApp):
+    """
+    WebSocketApp driven by an event loop instead of a thread, the loop
+    is a GLibEventLoop (the default) or a TornadoEventLoop, and many
+    connections can share it.
+
+    start() connects without blocking, and on_close is called once
+    when the connection is closed or can't be made. The callbacks are
+    called in the thread of the loop, and send() and close() must be
+    called from it too. Only ws:// urls are supported.
+    """
+    def __init__(self, url, loop=None, **kwargs):
+        """
+        url: websocket url.
+        loop: the event loop, see GLibEventLoop and TornadoEventLoop.
+        The other arguments are the ones of WebSocketApp.
+        """
+        WebSocketApp.__init__(self, url, **kwargs)
+        if loop is None:
+            loop = GLibEventLoop()
+        self.loop = loop
+        self._key = None
+        # [data, callback] of the frames not written
+        self._out = deque()
+        self._read_handle = None
+        self._write_handle = None
+        self._close_timeout = None
+        self._ping_timeout = None
+        self._connecting = False
+        self._closing = False
+        # bytes needed in the buffer to parse the next frame
+        self._needed = 0
+
+    @property
+    def buffered_amount(self):
+        """
+        Bytes queued by send() and not written to the socket yet.
+        """
+        return sum(len(data) for data, callback in self._out)
+
+    def start(self):
+        """
+        Start connecting, on_open is called when connected.
+        """
+        if self.sock:
+            raise WebSocketException("socket is already opened")
+        hostname, port, resource, is_secure = _parse_url(self.url)
+        if is_secure:
+            raise WebSocketException("secure websocket is not supported "
+                                     "by AsyncWebSocketApp")
+        self.keep_running = True
+        self._closing = False
+        self._needed = 0
+        self._out.clear()
+        self.sock = WebSocket(self.get_mask_key)
+        header_str, self._key = self.sock._get_handshake_request(
+            hostname, port, resource, subprotocols=self.subprotocols,
+            compression=self.compression)
+        self._out.append([memoryview(header_str), None])
+        if traceEnabled:
+            logger.debug( "--- request header ---")
+            logger.debug( header_str)
+            logger.debug("-----------------------")
+
+        sock = self.sock.sock
+        sock.setblocking(0)
+        error = sock.connect_ex((hostname, port))
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.loop.add_callback(
+                self._fail, socket.error(error, os.strerror(error)))
+            return
+        self._connecting = True
+        self._read_handle = self.loop.watch_read(sock.fileno(),
+                                                 self._on_readable)
+        self._write_handle = self.loop.watch_write(sock.fileno(),
+                                                   self._on_writable)
+
+    def send(self, data, opcode = ABNF.OPCODE_TEXT, callback = None):
+        """
+        Queue a message. data must be utf-8 string or unicode,
+        or a byte string if opcode is OPCODE_BINARY. callback is called
+        without arguments when the message is written to the socket.
+        """
+        if self.sock is None or self._closing:
+            raise WebSocketException("Connection is already closed.")
+        data = self.sock._format_frame(data, opcode)
+        if traceEnabled:
+            logger.debug("send: " + repr(data))
+        self._out.append([memoryview(data), callback])
+        if self._write_handle is None and not self._connecting:
+            self._flush()
+
+    def close(self):
+        """
+        Send the close frame, and close the connection when the server
+        reply, or after 3 seconds.
+        """
+        self.keep_running = False
+        if self.sock is None or self._closing:
+            return
+        if not self.sock.connected:
+            self._close_socket()
+            return
+        self.send(struct.pack('!H', STATUS_NORMAL), ABNF.OPCODE_CLOSE)
+        self._closing = True
+        self._close_timeout = self.loop.call_later(3, self._close_socket)
+
+    def _on_writable(self):
+        try:
+            if self._connecting:
+                error = self.sock.sock.getsockopt(socket.SOL_SOCKET,
+                                                  socket.SO_ERROR)
+                if error:
+                    raise socket.error(error, os.strerror(error))
+                self._connecting = False
+            self._flush()
+        except Exception, e:
+            self._fail(e)
+
+    def _flush(self):
+        while self._out:
+            data, callback = self._out[0]
+            try:
+                sent = self.sock.sock.send(data)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                break
+            if sent < len(data):
+                self._out[0][0] = data[sent:]
+                break
+            self._out.popleft()
+            if callback is not None:
+                callback()
+            if self.sock is None:
+                # closed by the callback
+                return
+
+        if self._out and self._write_handle is None:
+            self._write_handle = self.loop.watch_write(
+                self.sock.sock.fileno(), self._on_writable)
+        elif not self._out and self._write_handle is not None:
+            self.loop.remove_watch(self._write_handle)
+            self._write_handle = None
+
+    def _on_readable(self):
+        if self.sock is None:
+            return
+        try:
+            self.sock._buffer.fill(self._needed)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._fail(e)
+            return
+        except WebSocketException, e:
+            if self._closing:
+                # the server closed the connection
+                self._close_socket()
+            else:
+                self._fail(e)
+            return
+        try:
+            self._process()
+        except Exception, e:
+            self._fail(e)
+
+    def _process(self):
+        buf = self.sock._buffer
+        if not self.sock.connected:
+            if buf.find("\r\n\r\n") == -1:
+                if buf.pending() >= RECV_BUFFER_SIZE:
+                    raise WebSocketException("Invalid header")
+                self._needed = buf.pending() + 1
+                return
+            status, headers = self.sock._read_headers()
+            self.sock._check_handshake(status, headers, self._key)
+            if self.ping_interval:
+                self._ping_timeout = self.loop.call_later(
+                    self.ping_interval, self._on_ping_timeout)
+            self._run_with_no_err(self.on_open)
+
+        while self.sock is not None:
+            length = _get_frame_length(buf.peek(14))
+            if length is None or buf.pending() < length:
+                self._needed = length or 14
+                return
+            frame = self.sock.recv_frame()
+            if frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+                if not self._closing:
+                    self._run_with_no_err(self.on_message, frame.data)
+            elif frame.opcode == ABNF.OPCODE_CLOSE:
+                if self._closing:
+                    self._close_socket()
+                else:
+                    self.close()
+            elif frame.opcode == ABNF.OPCODE_PING and not self._closing:
+                self.send(frame.data, ABNF.OPCODE_PONG)
+            elif frame.opcode == ABNF.OPCODE_PONG:
+                self.sock._on_pong(frame.data)
+
+    def _on_ping_timeout(self):
+        self._ping_timeout = None
+        if self.sock is None or self._closing:
+            return
+        try:
+            delay = self._keepalive()
+        except Exception, e:
+            self._fail(e)
+            return
+        self._ping_timeout = self.loop.call_later(delay,
+                                                  self._on_ping_timeout)
+
+    def _fail(self, error):
+        self._run_with_no_err(self.on_error, error)
+        self._close_socket()
+
+    def _close_socket(self):
+        if self.sock is None:
+            return
+        for handle in (self._read_handle, self._write_handle):
+            if handle is not None:
+                self.loop.remove_watch(handle)
+        for handle in (self._close_timeout, self._ping_timeout):
+            if handle is not None:
+                self.loop.remove_timeout(handle)
+        self._read_handle = self._write_handle = None
+        self._close_timeout = self._ping_timeout = None
+        self._connecting = False
+        self.keep_running = False
+        self._out.clear()
+        self.sock._closeInternal()
+        self.sock = None
+        self._run_with_no_err(self.on_close)
+
+
 if __name__ == "__main__":
     enableTrace(True)
     ws = create_connection("ws://echo.websocket.org/")